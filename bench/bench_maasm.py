@@ -0,0 +1,273 @@
+#!/usr/bin/python3
+'''
+Benchmark suite for maasm.
+
+Generates synthetic programs, assembles them with the maasm command in a
+fresh process and compares the stage timings, throughput and peak memory
+reported by ``--profile`` against a baseline::
+
+    python bench/bench_maasm.py                 # small and medium cases
+    python bench/bench_maasm.py --scale large   # also the 10M line ones
+    python bench/bench_maasm.py --update        # record a new baseline
+'''
+
+import os
+import sys
+import json
+import random
+import shutil
+import platform
+import tempfile
+import subprocess
+
+import click
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+MAASM = os.path.join(os.path.dirname(HERE), 'maasm.py')
+BASELINE = os.path.join(HERE, 'baseline.json')
+
+sys.path.insert(0, os.path.dirname(HERE))
+from maasm import DEFAULT_INS, isa_args  # noqa
+
+# 32 bit instruction set with 16 bit jump targets, so large programs can
+# branch anywhere
+WIDE_INS = {
+    'NOP': {'op': 0, 'num': 0, 'args': [('zero', 24)]},
+    'LED': {'op': 2, 'num': 1, 'args': [('zero', 8), ('reg', 8),
+                                        ('zero', 8)]},
+    'BLE': {'op': 3, 'num': 3, 'args': [('value', 16), ('reg', 6),
+                                        ('reg', 6)]},
+    'STO': {'op': 4, 'num': 2, 'args': [('reg', 8), ('value', 16)]},
+    'ADD': {'op': 5, 'num': 3, 'args': [('reg', 8), ('reg', 8),
+                                        ('reg', 8)]},
+    'JMP': {'op': 6, 'num': 1, 'args': [('value', 16), ('zero', 8)]},
+    'SUB': {'op': 7, 'num': 3, 'args': [('reg', 8), ('reg', 8),
+                                        ('reg', 8)]},
+    'IMUL': {'op': 8, 'num': 2, 'args': [('zero', 8), ('reg', 8),
+                                         ('reg', 8)]},
+    '_config': {'ins_len': 32, 'opcode_len': 4, 'addr_len': 16},
+}
+
+ISAS = {'default': DEFAULT_INS, 'wide': WIDE_INS}
+
+# Throughput is only checked for cases whose baseline took at least this
+# many seconds, shorter runs are dominated by interpreter start-up
+MIN_SECONDS = 1.0
+
+# name: (isa, lines, label density, constant density, macro density, flags)
+CASES = {
+    'small': [
+        ('default-1k', 'default', 10 ** 3, 0.05, 0.01, 0.0, []),
+        ('wide-1k', 'wide', 10 ** 3, 0.05, 0.01, 0.05, []),
+    ],
+    'medium': [
+        ('default-100k', 'default', 10 ** 5, 0.05, 0.01, 0.0, []),
+        ('labels-100k', 'wide', 10 ** 5, 0.25, 0.01, 0.0, []),
+        ('constants-100k', 'wide', 10 ** 5, 0.01, 0.25, 0.0, []),
+        ('macros-100k', 'wide', 10 ** 5, 0.05, 0.01, 0.25, []),
+        ('stream-100k', 'default', 10 ** 5, 0.05, 0.01, 0.0, ['--stream']),
+        ('memh-100k', 'default', 10 ** 5, 0.05, 0.01, 0.0,
+         ['--format', 'memh']),
+    ],
+    'large': [
+        ('default-10M', 'wide', 10 ** 7, 0.05, 0.01, 0.0, []),
+        ('stream-10M', 'wide', 10 ** 7, 0.05, 0.01, 0.05, ['--stream']),
+    ],
+}
+SCALES = ['small', 'medium', 'large']
+
+
+def generate_program(output, isa, lines, label_density=0.05,
+                     constant_density=0.01, macro_density=0.0, seed=0):
+    '''
+    Write a random program of about ``lines`` lines to a text file.
+
+    Densities are the fraction of lines that define a label, define a
+    constant or invoke a macro. Value fields reference constants, labels
+    whose address fits in the field, or literals.
+    '''
+    rand = random.Random(seed)
+    mnemonics = sorted(name for name in isa if name != '_config')
+    fields = {
+        name: [(kind, length) for kind, length in isa_args(isa[name])
+               if kind != 'zero']
+        for name in mnemonics
+    }
+    labels = []
+    constants = []
+    address = 0
+    chunk = []
+
+    if macro_density:
+        chunk.append('.macro BUMP reg, step\n'
+                     '    ADD reg, reg, step\n'
+                     '    LED reg\n'
+                     '.endm\n')
+
+    def argument(kind, length):
+        if kind in ('reg', 'arg') and (kind == 'reg' or rand.random() < .8):
+            return 'R{}'.format(rand.randrange(min(2 ** length, 64)))
+        choice = rand.random()
+        if choice < .3 and constants:
+            name, value = rand.choice(constants)
+            if value < 2 ** length:
+                return name
+        if choice < .7 and labels:
+            name, value = labels[rand.randrange(len(labels))]
+            if value < 2 ** length:
+                return name
+        return str(rand.randrange(2 ** min(length, 8)))
+
+    for line in range(lines):
+        choice = rand.random()
+        if choice < label_density:
+            name = 'l{}'.format(line)
+            labels.append((name, address))
+            chunk.append('{}:\n'.format(name))
+        elif choice < label_density + constant_density:
+            name = 'C{}'.format(line)
+            value = rand.randrange(256)
+            constants.append((name, value))
+            chunk.append('{} = {}\n'.format(name, value))
+        elif choice < label_density + constant_density + macro_density:
+            chunk.append('    BUMP R{}, R{}\n'.format(
+                rand.randrange(16), rand.randrange(16)
+            ))
+            address += 2
+        else:
+            name = rand.choice(mnemonics)
+            chunk.append('    {} {}\n'.format(name, ', '.join(
+                argument(kind, length) for kind, length in fields[name]
+            )))
+            address += 1
+        if len(chunk) >= 4096:
+            output.write(''.join(chunk))
+            del chunk[:]
+    output.write(''.join(chunk))
+
+
+def run_case(case, workdir):
+    '''
+    Generate and assemble one case, returning its measurements.
+    '''
+    name, isa, lines, labels, constants, macros, flags = case
+    source = os.path.join(workdir, name + '.asm')
+    with open(source, 'w') as output:
+        generate_program(output, ISAS[isa], lines, labels, constants, macros)
+    asm_dict = os.path.join(workdir, isa + '.isa')
+    with open(asm_dict, 'w') as output:
+        output.write(repr(ISAS[isa]))
+    trace = os.path.join(workdir, name + '.json')
+
+    subprocess.check_call(
+        [sys.executable, MAASM, '--asm-dict', asm_dict, '--profile', trace]
+        + flags + [source, os.path.join(workdir, name + '.out')]
+    )
+    with open(trace) as trace_file:
+        report = json.load(trace_file)['otherData']
+    os.remove(source)
+    return {
+        'lines': lines,
+        'stages': report['stages'],
+        'total': report['total'],
+        'instructions': report['counters'].get('instructions'),
+        'instructions_per_second': report.get('instructions_per_second'),
+        'peak_memory': report['peak_memory'],
+    }
+
+
+def compare(name, result, baseline, tolerance):
+    '''
+    Return the regressions of a result against its baseline entry.
+
+    Throughput is skipped for cases whose baseline ran under
+    ``MIN_SECONDS``, peak memory is always checked.
+    '''
+    problems = []
+    expected = baseline.get('instructions_per_second')
+    measured = result['instructions_per_second']
+    if expected and baseline.get('total', 0) >= MIN_SECONDS and \
+            measured < expected * (1 - tolerance):
+        problems.append('{}: throughput {:.0f}/s below baseline {:.0f}/s'
+                        .format(name, measured, expected))
+    expected = baseline.get('peak_memory')
+    measured = result['peak_memory']
+    if expected and measured and measured > expected * (1 + tolerance):
+        problems.append('{}: peak memory {:.1f}MiB above baseline '
+                        '{:.1f}MiB'.format(name, measured / 2 ** 20,
+                                           expected / 2 ** 20))
+    return problems
+
+
+@click.command()
+@click.option('--scale', default='medium', type=click.Choice(SCALES),
+              help='Largest case scale to run (default medium)')
+@click.option('--case', 'only', multiple=True,
+              help='Run only the named cases')
+@click.option('--baseline', default=BASELINE, type=click.Path(),
+              help='Baseline file, defaults to bench/baseline.json')
+@click.option('--tolerance', default=0.25, type=float,
+              help='Allowed throughput and memory regression, 0.25 is 25%')
+@click.option('--update', is_flag=True,
+              help='Record the results as the new baseline')
+@click.option('--output', default=None, type=click.File('w'),
+              help='Also write the results as JSON to this file')
+def main(scale, only, baseline, tolerance, update, output):
+    '''
+    Run the benchmark cases and check them against the baseline.
+    '''
+    cases = [
+        case for level in SCALES[:SCALES.index(scale) + 1]
+        for case in CASES[level] if not only or case[0] in only
+    ]
+    results = {}
+    workdir = tempfile.mkdtemp(prefix='maasm-bench-')
+    try:
+        for case in cases:
+            result = results[case[0]] = run_case(case, workdir)
+            click.echo('{:<16} {:>9} lines {:>8.2f}s {:>10.0f} ins/s '
+                       '{:>8.1f}MiB'.format(
+                           case[0], result['lines'], result['total'],
+                           result['instructions_per_second'] or 0,
+                           (result['peak_memory'] or 0) / 2 ** 20))
+    finally:
+        shutil.rmtree(workdir)
+
+    document = {
+        'machine': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+        },
+        'results': results,
+    }
+    if output:
+        json.dump(document, output, indent=1, sort_keys=True)
+    if update:
+        if os.path.exists(baseline):
+            with open(baseline) as baseline_file:
+                previous = json.load(baseline_file)['results']
+            previous.update(results)
+            document['results'] = previous
+        with open(baseline, 'w') as baseline_file:
+            json.dump(document, baseline_file, indent=1, sort_keys=True)
+            baseline_file.write('\n')
+        return
+
+    if not os.path.exists(baseline):
+        return
+    with open(baseline) as baseline_file:
+        reference = json.load(baseline_file)['results']
+    problems = []
+    for name, result in sorted(results.items()):
+        if name in reference:
+            problems.extend(compare(name, result, reference[name],
+                                    tolerance))
+    for problem in problems:
+        click.echo(problem, err=True)
+    if problems:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
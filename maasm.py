@@ -1,8 +1,15 @@
  #!/usr/bin/python3
+import os
 import re
-from jinja2 import Template
-from collections import OrderedDict
-import click
+import io
+import time
+import sys
+from collections import OrderedDict, namedtuple
+from functools import lru_cache
+from contextlib import contextmanager, nullcontext
+
+__version__ = '2.1.0'
+
 DEFAULT_INS = {
     'NOP': {
         'op': 0,
@@ -32,17 +39,48 @@ DEFAULT_INS = {
     'JMP': {
         'op': 6,
         'num': 1,
-        'args': [('value', 16), ('zero', 8), ('zero', 8)]
+        'args': [('value', 8), ('zero', 8), ('zero', 8)]
     },
     '_config': {
         'ins_len': 28,
         'opcode_len': 4,
+        'addr_len': 16,
     }
 }
-TAGS = {}
-CONSTANTS = {}
+Token = namedtuple('Token', ['kind', 'name', 'args', 'line', 'column'])
 
-ROM_TEMPLATE = Template('''/*
+LINE_RE = re.compile(r'''
+    [ \t]*
+    (?:(?P<label>\w+)[ \t]*:[ \t]*)?
+    (?:
+        (?P<const>\w+)[ \t]*=[ \t]*(?P<value>[^\s\#]+)
+      | (?P<op>\w+)(?:[ \t,]+(?P<args>[^\#]*?))?
+      | \.(?P<directive>\w+)(?:[ \t]+(?P<params>[^\#]*?))?
+    )?
+    [ \t]*(?:\#[^\r\n]*)?\s*\Z
+''', re.X)
+# LINE_RE over raw bytes, one line per match, with a catch all for the
+# lines it can not take so they go through tokenize. Arguments match
+# greedily, trailing blanks are stripped with the rest of the spaces
+SOURCE_RE = re.compile(br'''
+    [ \t]*
+    (?:(?P<label>\w+)[ \t]*:[ \t]*)?
+    (?:
+        (?P<const>\w+)[ \t]*=[ \t]*(?P<value>[^\s\#]+)
+      | (?P<op>\w+)(?:[ \t,]+(?P<args>[^\#\r\n\f\v]*))?
+      | \.(?P<directive>\w+)(?:[ \t]+(?P<params>[^\#\r\n\f\v]*))?
+    )?
+    [ \t\r\f\v]*(?:\#[^\n]*)?(?:\n|\Z)
+  | (?P<error>[^\n]*)(?:\n|\Z)
+''', re.X)
+REG_RE = re.compile(r'R(\d{1,2})\Z')
+# Register names take one or two digits, R0 to R99, see REG_RE
+REGISTERS = 100
+PARAMS_RE = re.compile(r'[\s,]+')
+MACRO_DEPTH = 64
+
+# Jinja source of the ROM module, compiled on first use of ROM_TEMPLATE
+ROM_SOURCE = '''/*
 This module was out generated using maasm, MiniAlu's assembler
 report any bug to javinachop@gmail.com
 
@@ -70,215 +108,3165 @@ module ROM(
 
 endmodule
 `endif //ROM_A
-''')
+'''
+
+# ROM_SOURCE split around its case arms, for incremental writing
+ROM_HEADER = '''/*
+This module was out generated using maasm, MiniAlu's assembler
+report any bug to javinachop@gmail.com
+
+maasm is distributed under GNU GPL see <http://www.gnu.org/licenses/>
+*/
+`ifndef ROM_A
+`define ROM_A
+
+
+`timescale 1ns / 1ps
+module ROM(
+	   input wire [{addr_len}:0] iAddress,
+	   output reg [{ins_len}:0] oInstruction
+	   );
+ always @ ( iAddress )
+     begin
+	case (iAddress)
+          '''
+ROM_CASE = '''
+           {}: oInstruction = {}; // asm_ins[i]
+          '''
+ROM_FOOTER = '''
+	  default:
+	    oInstruction = { 4'b0010 ,  24'b10101010 };		//NOP
+	endcase
+     end
+
+endmodule
+`endif //ROM_A'''
+
+ROM_WRAPPER = '''/*
+This module was out generated using maasm, MiniAlu's assembler
+report any bug to javinachop@gmail.com
+
+maasm is distributed under GNU GPL see <http://www.gnu.org/licenses/>
+*/
+`ifndef ROM_A
+`define ROM_A
+
+
+`timescale 1ns / 1ps
+module ROM(
+	   input wire [{addr_len}:0] iAddress,
+	   output reg [{ins_len}:0] oInstruction
+	   );
+ reg [{ins_len}:0] rMemory [0:{last}];
+ initial
+     {readmem}("{image}", rMemory);
+ always @ ( iAddress )
+     begin
+	if (iAddress < {size})
+	    oInstruction = rMemory[iAddress];
+	else
+	    oInstruction = {{ 4'b0010 ,  24'b10101010 }};		//NOP
+     end
+
+endmodule
+`endif //ROM_A
+'''
+
+
+PREFIX_BASES = {'0x': 16, '0X': 16, '0b': 2, '0B': 2, '0o': 8, '0O': 8}
+VERILOG_BASES = {'h': 16, 'H': 16, 'b': 2, 'B': 2, 'o': 8, 'O': 8, 'd': 10,
+                 'D': 10}
 
 
+@lru_cache(maxsize=4096)
 def str2int(num):
-            try:
-                return int(num)
-            except:
-                pass
-            try:
-                return int(num, 2)
-            except:
-                pass
-            try:
-                return int(num, 6)
-            except:
-                pass
-            try:
-                return int(num, 8)
-            except:
-                raise Exception(
-                    'Unable to parse experssion {} to int '.format(num)
-                )
+    ''' Parses an integer literal
+
+    Literals are decimal unless prefixed with ``0x``, ``0b`` or ``0o``, or
+    written in verilog style as ``[size]'<base><digits>`` with base ``h``,
+    ``b``, ``o`` or ``d``. Results are memoized, as generated code repeats
+    the same immediates over and over.
+    '''
+    try:
+        if "'" in num:
+            size, _, digits = num.partition("'")
+            value = int(digits[1:], VERILOG_BASES[digits[:1]])
+            if size and value >> int(size):
+                raise ValueError('{} does not fit in {} bits'.format(
+                    value, size
+                ))
+            return value
+        base = PREFIX_BASES.get(num[:2])
+        if base:
+            return int(num[2:], base)
+        return int(num, 10)
+    except (KeyError, ValueError) as err:
+        raise Exception(
+            'Unable to parse expression {} to int'.format(num)
+        ) from err
 
 
-def map_args(kind, length, arg=None):
+def map_args(kind, arg=None, tags=None, constants=None):
+    ''' Returns the integer value of an instruction argument
+
+    Symbols are looked up in the ``tags`` and ``constants`` tables.
+    '''
     if kind == 'zero':
-        return '{{0:0{}b}}'.format(length).format(0)
+        return 0
 
     elif kind == 'value':
-        if arg in TAGS:
-            return '{{0:0{}b}}'.format(length).format(TAGS[arg])
-        elif arg in CONSTANTS:
-            return '{{0:0{}b}}'.format(length).format(CONSTANTS[arg])
-        elif re.match(r'\d', arg):
-            return '{{0:0{}b}}'.format(length).format(str2int(arg))
+        if tags and arg in tags:
+            return tags[arg]
+        elif constants and arg in constants:
+            return constants[arg]
+        elif is_literal(arg):
+            return str2int(arg)
         else:
-            raise Exception('Undefined Symbol: {}').format(arg)
+            raise Exception('Undefined Symbol: {}'.format(arg))
 
     elif kind == 'reg':
-        if re.match(r'R\d{1,2}', arg):
-            return '{{0:0{}b}}'.format(length).format(
-                int(arg.split('R', 1)[1])
-            )
+        match = REG_RE.match(arg)
+        if match:
+            return int(match.group(1))
         else:
-            raise Exception('Malformed register expression {}'.fromat(arg))
+            raise Exception('Malformed register expression {}'.format(arg))
+
+    elif kind == 'arg':
+        if REG_RE.match(arg):
+            return map_args('reg', arg)
+        return map_args('value', arg, tags, constants)
 
     else:
-        raise Exception('Invaild type {}').format(kind)
+        raise Exception('Invaild type {}'.format(kind))
+
+
+def is_literal(arg):
+    return arg[:1].isdigit() or arg[:1] == "'"
 
 
-def expand_macro(text, macros_dict):
-    expanded_text = list(text)
-    for i in range(len(text)):
-        line = text[i].split('#', 1)[0]
-        if re.match(r'(\w*):', line[0]) or re.match(r'\w*=\d*', line[0]):
+def is_symbol(arg):
+    return not (is_literal(arg) or REG_RE.match(arg))
+
+
+def compile_isa(asm_def):
+    ''' Compiles an instruction set dictionary into encoder tables
+
+    Every mnemonic is mapped to a tuple ``(opword, num, fields)``, where
+    ``opword`` is the opcode already shifted into place and ``fields`` holds
+    a ``(kind, shift, mask)`` entry for each argument taken from the source.
+    Fields are packed from the least significant bit, so an instruction whose
+    arguments are narrower than ``ins_len`` is zero extended on the left.
+    The ``_config`` entry is copied along with the binary format spec used at
+    emit time.
+    '''
+    config = dict(asm_def['_config'])
+    ins_len = config['ins_len']
+    opcode_len = config['opcode_len']
+    config['bin_format'] = '0{}b'.format(ins_len)
+    config['hex_format'] = '0{}x'.format((ins_len + 3) // 4)
+    isa = {'_config': config}
+
+    for name, ins in asm_def.items():
+        if name == '_config':
             continue
-        else:
-            ins = line.split[',']
-        if ins[0] in macros_dict:
-            expanded_text[i] = macros_dict[ins[0]]['func'](ins[1:])
-    return [item for sublist in expanded_text[i] for item in sublist]
-
-
-def resolve_symbols(text):
-    whitelines = 0
-    for i in range(len(text)):
-        if text[i].strip() == '':
-            whitelines += 1
-        elif re.match(r'\w*=\d*(\s*#\s*\w*)?', text[i]):
-            line = text[i].split('#', 1)[0].split('=')
-            try:
-                CONSTANTS[line[0]] = str2int(line[1])
-            except Exception as err:
+        args = isa_args(ins)
+        shift = sum(length for _, length in args)
+        if shift + opcode_len > ins_len:
+            raise Exception(
+                'Instruction {} does not fit in {} bits'.format(name, ins_len)
+            )
+        if ins['op'] >> opcode_len:
+            raise Exception(
+                'Opcode of {} does not fit in {} bits'.format(name, opcode_len)
+            )
+        opword = ins['op'] << shift
+        fields = []
+        for kind, length in args:
+            shift -= length
+            if kind != 'zero':
+                fields.append((kind, shift, (1 << length) - 1))
+        if len(fields) != ins['num']:
+            raise Exception(
+                'Instruction {} takes {} arguments but defines {}'.format(
+                    name, ins['num'], len(fields)
+                )
+            )
+        isa[name] = (opword, ins['num'], fields)
+    return isa
+
+
+def isa_args(ins):
+    ''' Returns the ``(kind, length)`` arguments of an instruction entry '''
+    return [
+        (arg, 8) if isinstance(arg, str) else tuple(arg)
+        for arg in ins['args']
+    ]
+
+
+ARG_KINDS = ('zero', 'value', 'reg', 'arg')
+INS_KEYS = {'op', 'num', 'args'}
+# optional _config keys, with the value used when they are left out
+EXTRA_CONFIG = {'reg_len': 16}
+
+
+def validate_isa(asm_def):
+    ''' Checks an instruction set dictionary and fills in its defaults
+
+    Every instruction must have exactly an integer ``op`` and ``num`` and an
+    ``args`` list of kinds or ``(kind, length)`` pairs. ``_config`` entries
+    missing from the dictionary are taken from ``DEFAULT_INS``, and it may
+    also set the ``EXTRA_CONFIG`` ones, such as the simulator register
+    width ``reg_len``. Returns a new dictionary, raising an exception on the
+    first problem found.
+    '''
+    def count(value, minimum=1):
+        return type(value) is int and value >= minimum
+
+    if not isinstance(asm_def, dict):
+        raise Exception('Instruction set must be a dictionary, not {}'.format(
+            type(asm_def).__name__
+        ))
+    config = asm_def.get('_config', {})
+    if not isinstance(config, dict):
+        raise Exception('Instruction set _config must be a dictionary')
+    unknown = set(config) - set(DEFAULT_INS['_config']) - set(EXTRA_CONFIG)
+    if unknown:
+        raise Exception('Unknown _config keys: {}'.format(
+            ', '.join(sorted(map(str, unknown)))
+        ))
+    config = dict(DEFAULT_INS['_config'], **config)
+    for key, value in sorted(config.items()):
+        if not count(value):
+            raise Exception(
+                '_config {} must be a positive integer, got {!r}'.format(
+                    key, value
+                )
+            )
+    if config['opcode_len'] > config['ins_len']:
+        raise Exception('_config opcode_len is larger than ins_len')
+    if config.get('reg_len', 0) > 64:
+        raise Exception('_config reg_len is larger than 64')
+
+    checked = {'_config': config}
+    for name, ins in asm_def.items():
+        if name == '_config':
+            continue
+        if not isinstance(name, str) or not re.match(r'\w+\Z', name):
+            raise Exception('Invalid instruction name {!r}'.format(name))
+        if not isinstance(ins, dict) or set(ins) != INS_KEYS:
+            raise Exception(
+                'Instruction {} must have exactly the keys op, num and '
+                'args'.format(name)
+            )
+        for key in ('op', 'num'):
+            if not count(ins[key], 0):
                 raise Exception(
-                    '{}: Unable to parse'
-                    ' constant expression {}'.format(text[i])
-                ) from err
+                    'Instruction {} {} must be a non negative integer, got '
+                    '{!r}'.format(name, key, ins[key])
+                )
+        if not isinstance(ins['args'], (list, tuple)):
+            raise Exception('Instruction {} args must be a list'.format(name))
+        args = []
+        for arg in ins['args']:
+            if isinstance(arg, str):
+                arg = (arg, 8)
+            if not (isinstance(arg, (list, tuple)) and len(arg) == 2
+                    and arg[0] in ARG_KINDS and count(arg[1])):
+                raise Exception(
+                    'Instruction {} has an invalid argument {!r}, expected '
+                    'one of {} or a (kind, length) pair'.format(
+                        name, arg, ', '.join(ARG_KINDS)
+                    )
+                )
+            args.append(tuple(arg))
+        checked[name] = {'op': ins['op'], 'num': ins['num'], 'args': args}
+    compile_isa(checked)
+    return checked
 
-    whitelines = 0
-    for i in range(len(text)):
-        match = re.match('(\w*):(\s*#\s*\w*)?', text[i])
-        if match:
-            TAGS[match.group(1)] = i-len(TAGS)-len(CONSTANTS)-whitelines
-        elif text[i].strip() == '':
-            whitelines += 1
 
+def parse_isa(text):
+    ''' Parses and validates an instruction set file
+
+    The file holds a python dictionary literal, read with
+    ``ast.literal_eval`` so that it can not run any code.
+    '''
+    import ast
+    if isinstance(text, bytes):
+        text = text.decode('utf-8')
+    try:
+        asm_def = ast.literal_eval(text)
+    except (ValueError, SyntaxError) as err:
+        raise Exception('Instruction set is not a python literal') from err
+    return validate_isa(asm_def)
 
-def asemble(text, asm_def):
-    bytecode = []
-    asm_ins = []
-    for index, line in enumerate(text):
-        if line == '':
+
+def compile_decoder(asm_def):
+    ''' Builds the decode table of an instruction set
+
+    Returns ``(shifts, table)``: ``table`` maps ``(shift, opcode)`` to the
+    mnemonic and its ``(kind, shift, mask)`` fields as in ``compile_isa``,
+    where ``shift`` is the position of the opcode, and ``shifts`` lists the
+    distinct opcode positions of the instruction set.
+    '''
+    isa = compile_isa(asm_def)
+    table = {}
+    for name, ins in asm_def.items():
+        if name == '_config':
             continue
+        shift = sum(length for _, length in isa_args(ins))
+        table[(shift, ins['op'])] = (name, isa[name][2])
+    return sorted(set(shift for shift, _ in table)), table
+
+
+def decode(decoder, word):
+    ''' Returns the mnemonic and field values of a word, or ``None`` '''
+    shifts, table = decoder
+    for shift in shifts:
+        entry = table.get((shift, word >> shift))
+        if entry:
+            name, fields = entry
+            return name, [
+                (word >> field_shift) & mask
+                for _, field_shift, mask in fields
+            ]
+    return None
+
+
+def encode(isa, op, args, tags=None, constants=None, relocs=None):
+    ''' Packs an instruction and its arguments into a single int
+
+    When a ``relocs`` list is given, fields referencing a symbol missing
+    from both tables are left as zero and ``(shift, mask, symbol)`` is
+    appended to ``relocs`` to be patched later.
+    '''
+    opword, _, fields = isa[op]
+    for (kind, shift, mask), arg in zip(fields, args):
+        if (relocs is not None and kind in ('value', 'arg') and
+                is_symbol(arg) and not (tags and arg in tags) and
+                not (constants and arg in constants)):
+            relocs.append((shift, mask, arg))
+            continue
+        opword |= check_field(map_args(kind, arg, tags, constants), mask,
+                              arg) << shift
+    return opword
+
+
+def check_field(value, mask, arg):
+    if value < 0 or value > mask:
+        raise Exception(
+            'Value {} does not fit in {} bits'.format(arg, mask.bit_length())
+        )
+    return value
+
+
+def tokenize(lines, first_line=1):
+    ''' Scans source lines into a stream of tokens
+
+    Yields a ``Token`` for every label (``name:``), constant (``NAME=N``),
+    instruction (``OP,arg,...`` or ``OP arg, ...``) and directive
+    (``.name arg ...``) found, with the line and column where it starts.
+    Blank lines and comments produce no tokens.
+    '''
+    for number, text in enumerate(lines, first_line):
+        match = LINE_RE.match(text)
+        if not match:
+            raise Exception(
+                '{}: Syntax error on line {}'.format(number, text.rstrip())
+            )
+        if match.group('label'):
+            yield Token(
+                'label', match.group('label'), (),
+                number, match.start('label') + 1
+            )
+        if match.group('const'):
+            yield Token(
+                'const', match.group('const'), (match.group('value'),),
+                number, match.start('const') + 1
+            )
+        elif match.group('op'):
+            args = match.group('args')
+            yield Token(
+                'ins', match.group('op'),
+                tuple(arg.strip() for arg in args.split(',')) if args else (),
+                number, match.start('op') + 1
+            )
+        elif match.group('directive'):
+            params = match.group('params')
+            yield Token(
+                'directive', match.group('directive'),
+                tuple(PARAMS_RE.split(params.strip())) if params else (),
+                number, match.start('directive')
+            )
 
-        ins = line.split('#', 1)[0]
-        if ins:
-            ins = ins.split(',')
-            if re.match(r'(\w*):', ins[0]) or re.match(r'\w*=\d*', ins[0]):
-                continue
 
-            elif ins[0] in asm_def:
-                asm_def.append(' '.join(ins))
-                if len(ins) == (asm_def[ins[0]]['num'] + 1):
-
-                    # FIXME: Make length configurable
-                    bytecode_line = [
-                        '{{0:0{}b}}'.format(
-                            asm_def['_config']['opcode_len']
-                        ).format(asm_def[ins[0]]['op']),
-                    ]
-                    iter_args = iter(ins[1:])
-                    for arg in asm_def[ins[0]]['args']:
-                        kind = arg[0]
-                        length = arg[1]
-                        if kind == 'zero':
-                            bytecode_line.append(map_args(kind, length))
-                        else:
-                            try:
-                                bytecode_line.append(
-                                    map_args(kind, length, next(iter_args))
-                                )
-                            except Exception as err:
-                                raise Exception(
-                                    '{}: Unable to parse'
-                                    ' args on instruction: {}'.format(
-                                        index, line
-                                    )
-                                ) from err
-                    bytecode.append(''.join(bytecode_line))
+def scan_source(data, first_line=1, cache_size=1 << 12):
+    ''' Scans a bytes-like source, such as an ``mmap``, into tokens
 
+    Gives the same tokens as ``tokenize`` over the decoded lines split at
+    ``\\n``, but matches the buffer in place and only copies and decodes
+    the names and arguments it yields, so there is no decoded copy of the
+    whole source. A line that does not match as ASCII bytes, such as one
+    with a non ASCII name or a syntax error, is decoded and handed to
+    ``tokenize``.
+
+    Decoded names and arguments are shared between repeated lines, and
+    each of those caches is cleared once it holds ``cache_size`` entries.
+    '''
+    size = len(data)
+    names = {}
+    arguments = {}
+    number = first_line
+    for match in SOURCE_RE.finditer(data):
+        start = match.start()
+        if start == size:
+            break
+        label, const, value, op, args, directive, params, error = \
+            match.groups()
+        if error is not None:
+            yield from tokenize([error.decode('utf-8')], number)
+        elif label is not None or const is not None or op is not None or \
+                directive is not None:
+            if label is not None:
+                name = names.get(label)
+                if name is None:
+                    if len(names) >= cache_size:
+                        names.clear()
+                    name = names[label] = label.decode('ascii')
+                yield Token(
+                    'label', name, (), number, match.start('label') - start + 1
+                )
+            if const is not None:
+                yield Token(
+                    'const', const.decode('ascii'), (value.decode('utf-8'),),
+                    number, match.start('const') - start + 1
+                )
+            elif op is not None:
+                name = names.get(op)
+                if name is None:
+                    if len(names) >= cache_size:
+                        names.clear()
+                    name = names[op] = op.decode('ascii')
+                if args:
+                    parsed = arguments.get(args)
+                    if parsed is None:
+                        if len(arguments) >= cache_size:
+                            arguments.clear()
+                        parsed = arguments[args] = tuple(
+                            arg.strip()
+                            for arg in args.decode('utf-8').split(',')
+                        )
                 else:
-                    raise Exception(
-                        '{}: Wrong number of'
-                        ' arguments on instruction {}'.format(index, line)
-                    )
+                    parsed = ()
+                yield Token(
+                    'ins', name, parsed, number, match.start('op') - start + 1
+                )
+            elif directive is not None:
+                params = params.decode('utf-8').strip() if params else ''
+                yield Token(
+                    'directive', directive.decode('ascii'),
+                    tuple(PARAMS_RE.split(params)) if params else (),
+                    number, match.start('directive') - start
+                )
+        number += 1
+
+
+def map_source(source):
+    ''' Maps a binary file in memory for ``scan_source``
+
+    Returns a read only ``mmap``, or ``None`` if the file can not be mapped,
+    like pipes and empty files.
+    '''
+    import mmap
+    try:
+        return mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError, io.UnsupportedOperation):
+        return None
+
+
+def count_lines(data, chunk_size=1 << 20):
+    ''' Counts the newlines of a bytes-like source, a chunk at a time '''
+    return sum(
+        data[start:start + chunk_size].count(b'\n')
+        for start in range(0, len(data), chunk_size)
+    )
 
+
+def release_source(data):
+    ''' Closes a mapped source after a failed assembly
+
+    A scan stopped halfway by an error still holds the buffer, so closing
+    the map raises ``BufferError``; it is then left to be released with
+    the scan, and the error that stopped it goes on.
+    '''
+    try:
+        data.close()
+    except BufferError:
+        pass
+
+
+@contextmanager
+def read_source(source):
+    ''' Gives the contents of a binary file, mapped in memory if possible '''
+    data = map_source(source)
+    if data is None:
+        yield source.read()
+        return
+    try:
+        yield data
+    except BaseException:
+        release_source(data)
+        raise
+    data.close()
+
+
+def expand_macro(tokens, macros_dict=None, max_depth=MACRO_DEPTH):
+    ''' Lazily expands the macros of a token stream, see ``MacroExpander`` '''
+    return MacroExpander(macros_dict, max_depth).expand(tokens)
+
+
+class MacroExpander(object):
+    ''' Expands assembly and Python macros in a token stream
+
+    Assembly macros are defined in the source itself::
+
+        .macro INC reg, step
+            ADD reg, reg, step
+        .endm
+
+    and arguments equal to a parameter name are replaced on invocation.
+    Python macros come from ``macros_dict``, as loaded by ``load_macros``:
+    ``macros_dict[name]['func'](args)`` returns the lines to assemble.
+    Both kinds may invoke other macros up to ``max_depth`` levels deep.
+
+    The expansion of each ``(name, args)`` invocation is computed once and
+    kept in a ``cache_size`` entries LRU cache, so Python macros must be
+    pure. Labels defined by an expansion get a ``.N`` suffix unique to each
+    invocation. Expanded tokens take the line and column of the invocation.
+    '''
+
+    def __init__(self, macros_dict=None, max_depth=MACRO_DEPTH,
+                 cache_size=1024):
+        self.macros_dict = macros_dict or {}
+        self.max_depth = max_depth
+        self.cache_size = cache_size
+        self.definitions = {}
+        self.cache = OrderedDict()
+        self.invocations = 0
+
+    def is_macro(self, token):
+        return token.kind == 'ins' and (
+            token.name in self.definitions or token.name in self.macros_dict
+        )
+
+    def expand(self, tokens):
+        tokens = iter(tokens)
+        for token in tokens:
+            if token.kind == 'directive':
+                self.directive(token, tokens)
+            elif self.is_macro(token):
+                for expanded in self.invoke(token, 1):
+                    yield expanded
             else:
+                yield token
+
+    def directive(self, token, tokens):
+        if token.name != 'macro':
+            raise Exception(
+                '{}: Unknown directive .{}'.format(token.line, token.name)
+            )
+        if not token.args:
+            raise Exception('{}: Missing macro name'.format(token.line))
+        body = []
+        for inner in tokens:
+            if inner.kind == 'directive':
+                if inner.name == 'endm':
+                    break
                 raise Exception(
-                    '{}: Invalid operation'
-                    ' on instruction {}'.format(index, line)
+                    '{}: Unexpected .{} inside macro {}'.format(
+                        inner.line, inner.name, token.args[0]
+                    )
                 )
-    return bytecode, asm_ins
+            body.append(inner)
+        else:
+            raise Exception(
+                '{}: Macro {} lacks .endm'.format(token.line, token.args[0])
+            )
+        self.definitions[token.args[0]] = (token.args[1:], body)
+        self.cache.clear()
 
+    def invoke(self, token, depth):
+        if depth > self.max_depth:
+            raise Exception(
+                '{}: Macro {} nests deeper than {} levels'.format(
+                    token.line, token.name, self.max_depth
+                )
+            )
+        key = (token.name, token.args)
+        entry = self.cache.get(key)
+        if entry is None:
+            expansion = list(self.body(token, depth))
+            entry = self.cache[key] = (expansion, frozenset(
+                inner.name for inner in expansion if inner.kind == 'label'
+            ))
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        else:
+            self.cache.move_to_end(key)
+        return self.place(entry, token)
 
-def generate_rom(text):
-    pass
+    def body(self, token, depth):
+        if token.name in self.definitions:
+            params, body = self.definitions[token.name]
+            if len(params) != len(token.args):
+                raise Exception(
+                    '{}: Macro {} takes {} arguments'.format(
+                        token.line, token.name, len(params)
+                    )
+                )
+            values = dict(zip(params, token.args))
+            tokens = (
+                inner._replace(args=tuple(
+                    values.get(arg, arg) for arg in inner.args
+                )) for inner in body
+            )
+        else:
+            tokens = tokenize(
+                self.macros_dict[token.name]['func'](list(token.args))
+            )
+        for inner in tokens:
+            if inner.kind == 'directive':
+                raise Exception(
+                    '{}: Unexpected .{} in macro {}'.format(
+                        token.line, inner.name, token.name
+                    )
+                )
+            elif self.is_macro(inner):
+                for expanded in self.invoke(inner, depth + 1):
+                    yield expanded
+            else:
+                yield inner
 
+    def place(self, entry, token):
+        expansion, labels = entry
+        if labels:
+            self.invocations += 1
+            suffix = '.{}'.format(self.invocations)
+        for inner in expansion:
+            if labels:
+                if inner.kind == 'label':
+                    inner = inner._replace(name=inner.name + suffix)
+                else:
+                    inner = inner._replace(args=tuple(
+                        arg + suffix if arg in labels else arg
+                        for arg in inner.args
+                    ))
+            yield inner._replace(line=token.line, column=token.column)
 
-@click.command()
-@click.argument('filename', type=click.File('rb'))
-@click.argument('output', type=click.File('wb'))
-@click.option(
-    '--asm-dict', default=None, type=click.File('rb'),
-    help='File containing a python dictionary with the asm instructions set')
-@click.option(
-    '--macros', default=None,
-    help='File containing a python module with macro definitions')
-def main(filename, output, asm_dict, macros):
-    ''' Transforms from MiniAlu assembly to a verilog ROM module
 
-    FILENAME: Input asm file
+def resolve_symbols(tokens, tags, constants):
+    ''' Collects labels into ``tags`` and constants into ``constants``
 
-    OUTPUT: Output verilog ROM module file
-'''
-    if macros:
-        import sys
-        import os.path
-        from importlib import import_module
-        m_path = os.path.abspath(
-            os.path.expandvars(
-                os.path.expanduser(
-                    macros
+    Only the first definition of each name is kept: it is the value taken
+    by the references that come before any definition of the symbol. A
+    reference after a definition takes the latest one before it, so the
+    encoding pass overwrites the tables as it goes, see ``assemble_tokens``.
+    Returns the number of instructions.
+    '''
+    address = 0
+    for token in tokens:
+        if token.kind == 'ins':
+            address += 1
+        elif token.name in tags or token.name in constants:
+            continue
+        elif token.kind == 'label':
+            tags[token.name] = address
+        elif token.kind == 'const':
+            constants[token.name] = parse_constant(token)
+    return address
+
+
+def parse_constant(token):
+    try:
+        return str2int(token.args[0])
+    except Exception as err:
+        raise Exception(
+            '{}: Unable to parse'
+            ' constant expression {}'.format(token.line, token.args[0])
+        ) from err
+
+
+def encode_token(isa, token, tags=None, constants=None, relocs=None):
+    ''' Encodes an instruction token, reporting errors with its position '''
+    check_token(isa, token)
+    try:
+        return encode(isa, token.name, token.args, tags, constants, relocs)
+    except Exception as err:
+        raise Exception(
+            '{}:{}: Unable to parse'
+            ' args on instruction: {}'.format(
+                token.line, token.column, token_text(token)
+            )
+        ) from err
+
+
+def check_token(isa, token):
+    ''' Checks the mnemonic and number of arguments of an instruction '''
+    if token.name not in isa or token.name == '_config':
+        raise Exception(
+            '{}: Invalid operation'
+            ' on instruction {}'.format(token.line, token_text(token))
+        )
+    if len(token.args) != isa[token.name][1]:
+        raise Exception(
+            '{}: Wrong number of'
+            ' arguments on instruction {}'.format(
+                token.line, token_text(token)
+            )
+        )
+
+
+def token_text(token):
+    return ' '.join((token.name, ','.join(token.args)))
+
+
+def assemble_tokens(tokens, isa, tags, constants, memo=None):
+    ''' Encodes a token stream in a single pass
+
+    Labels take the value of the location counter and constants are parsed
+    as they are found, filling ``tags`` and ``constants``, so a reference
+    takes the latest definition before it. Fields naming a symbol not
+    defined yet are recorded in a fixup table and patched, once the whole
+    stream has been read, with the first definition of the symbol.
+    ``isa`` is a compiled instruction set.
+
+    ``memo`` optionally maps ``(name, args)`` to already encoded words; it is
+    looked up before encoding and filled with every instruction that needed
+    no fixup. It only holds for programs that define each symbol once.
+    '''
+    words = []
+    earliest = {}
+    fixups = []
+    pending = []
+    for token in tokens:
+        if token.kind == 'label':
+            tags[token.name] = len(words)
+            earliest.setdefault(token.name, len(words))
+        elif token.kind == 'const':
+            constants[token.name] = parse_constant(token)
+            earliest.setdefault(token.name, constants[token.name])
+        elif memo is None:
+            words.append(encode_token(isa, token, tags, constants, pending))
+        else:
+            key = (token.name, token.args)
+            word = memo.get(key)
+            if word is None:
+                word = encode_token(isa, token, tags, constants, pending)
+                if not pending:
+                    memo[key] = word
+            words.append(word)
+        if pending:
+            for shift, mask, symbol in pending:
+                fixups.append((len(words) - 1, shift, mask, symbol, token))
+            del pending[:]
+
+    for index, shift, mask, symbol, token in fixups:
+        try:
+            value = map_args('value', symbol, earliest)
+            words[index] |= check_field(value, mask, symbol) << shift
+        except Exception as err:
+            raise Exception(
+                '{}:{}: Unable to parse'
+                ' args on instruction: {}'.format(
+                    token.line, token.column, token_text(token)
+                )
+            ) from err
+    return words
+
+
+class Program(object):
+    ''' Compact intermediate representation of a token stream
+
+    Instructions live in parallel ``array`` columns rather than in token
+    objects: ``ops`` holds the index of each mnemonic in ``names``,
+    ``operands`` the arguments of all the instructions one after another, as
+    ids into the ``strings`` table, and ``lines`` and ``columns`` where each
+    instruction starts. Label and constant definitions are kept in
+    ``symbols`` as ``(instruction, kind, name, value)`` in source order,
+    where ``instruction`` is the number of instructions before them.
+
+    Mnemonics and argument counts are checked against the compiled ``isa``
+    while the tokens are read.
+    '''
+
+    __slots__ = ('isa', 'names', 'strings', 'ids', 'ops', 'operands', 'lines',
+                 'columns', 'symbols')
+
+    def __init__(self, isa, tokens=()):
+        from array import array
+        self.isa = isa
+        self.names = sorted(name for name in isa if name != '_config')
+        self.strings = []
+        self.ids = {}
+        self.ops = array('H')
+        self.operands = array('I')
+        self.lines = array('I')
+        self.columns = array('H')
+        self.symbols = []
+        self.extend(tokens)
+
+    def __len__(self):
+        return len(self.ops)
+
+    def extend(self, tokens):
+        ''' Appends a token stream to the program '''
+        ops = self.ops
+        operands = self.operands
+        lines = self.lines
+        columns = self.columns
+        ids = self.ids
+        strings = self.strings
+        names = {name: index for index, name in enumerate(self.names)}
+        for token in tokens:
+            if token.kind == 'label':
+                self.symbols.append((len(ops), 'label', token.name, len(ops)))
+                continue
+            if token.kind == 'const':
+                self.symbols.append(
+                    (len(ops), 'const', token.name, parse_constant(token))
+                )
+                continue
+            check_token(self.isa, token)
+            ops.append(names[token.name])
+            for arg in token.args:
+                index = ids.get(arg)
+                if index is None:
+                    index = ids[arg] = len(strings)
+                    strings.append(arg)
+                operands.append(index)
+            lines.append(token.line)
+            columns.append(min(token.column, 0xffff))
+
+    def arities(self):
+        ''' Returns the number of operands of each entry of ``names`` '''
+        return [self.isa[name][1] for name in self.names]
+
+    def text(self, index, operand):
+        ''' Returns the source text of an instruction, see ``token_text`` '''
+        name = self.names[self.ops[index]]
+        args = self.operands[operand:operand + self.isa[name][1]]
+        return ' '.join((name, ','.join(self.strings[arg] for arg in args)))
+
+    def tokens(self):
+        ''' Yields the program back as tokens '''
+        symbols = iter(self.symbols)
+        symbol = next(symbols, None)
+        operand = 0
+        for index, op in enumerate(self.ops):
+            while symbol is not None and symbol[0] == index:
+                yield Token(symbol[1], symbol[2], (
+                    (str(symbol[3]),) if symbol[1] == 'const' else ()
+                ), 0, 0)
+                symbol = next(symbols, None)
+            name = self.names[op]
+            num = self.isa[name][1]
+            yield Token('ins', name, tuple(
+                self.strings[arg]
+                for arg in self.operands[operand:operand + num]
+            ), self.lines[index], self.columns[index])
+            operand += num
+        while symbol is not None:
+            yield Token(symbol[1], symbol[2], (
+                (str(symbol[3]),) if symbol[1] == 'const' else ()
+            ), 0, 0)
+            symbol = next(symbols, None)
+
+
+def encode_program(program, tags, constants, start=0, end=None, operand=0):
+    ''' Encodes a ``Program`` into an ``array`` of words
+
+    Symbols resolve as in ``assemble_tokens``: definitions are applied as
+    they are reached, filling ``tags`` and ``constants``, and fields naming
+    a symbol not defined yet are patched with its first definition once the
+    end is reached. Literal
+    and register arguments are converted once per distinct string and
+    field. ``start``, ``end`` and ``operand``, the position of the first
+    operand of instruction ``start``, select a slice to encode against
+    complete symbol tables. Instructions wider than 64 bits give a list.
+    '''
+    from array import array
+    isa = program.isa
+    ins_len = isa['_config']['ins_len']
+    words = array('I' if ins_len <= 32 else 'Q') if ins_len <= 64 else []
+    caches = {}
+    entries = [
+        (isa[name][0], [
+            (kind, shift, mask, caches.setdefault((kind, mask), {}))
+            for kind, shift, mask in isa[name][2]
+        ])
+        for name in program.names
+    ]
+    strings = program.strings
+    operands = program.operands
+    ops = program.ops
+    symbolic = {}
+    earliest = {}
+    fixups = []
+    symbols = [symbol for symbol in program.symbols if symbol[0] >= start]
+    symbols.reverse()
+    end = len(program) if end is None else end
+
+    for index in range(start, end):
+        while symbols and symbols[-1][0] == index:
+            _, kind, name, value = symbols.pop()
+            (tags if kind == 'label' else constants)[name] = value
+            earliest.setdefault(name, value)
+        word, fields = entries[ops[index]]
+        first = operand
+        operand += len(fields)
+        try:
+            for (kind, shift, mask, cache), arg in zip(
+                    fields, operands[first:operand]):
+                value = cache.get(arg)
+                if value is None:
+                    text = strings[arg]
+                    if arg not in symbolic:
+                        symbolic[arg] = is_symbol(text)
+                    if not (symbolic[arg] and kind != 'reg'):
+                        value = cache[arg] = check_field(
+                            map_args(kind, text), mask, text
+                        )
+                    elif text in tags or text in constants:
+                        value = check_field(
+                            map_args(kind, text, tags, constants), mask, text
+                        )
+                    else:
+                        fixups.append((index, first, arg, shift, mask))
+                        continue
+                word |= value << shift
+        except Exception as err:
+            raise Exception(
+                '{}:{}: Unable to parse'
+                ' args on instruction: {}'.format(
+                    program.lines[index], program.columns[index],
+                    program.text(index, first)
+                )
+            ) from err
+        words.append(word)
+
+    for _, kind, name, value in reversed(symbols):
+        (tags if kind == 'label' else constants)[name] = value
+        earliest.setdefault(name, value)
+    for index, operand, arg, shift, mask in fixups:
+        text = strings[arg]
+        try:
+            value = map_args('value', text, earliest)
+            words[index - start] |= check_field(value, mask, text) << shift
+        except Exception as err:
+            raise Exception(
+                '{}:{}: Unable to parse'
+                ' args on instruction: {}'.format(
+                    program.lines[index], program.columns[index],
+                    program.text(index, operand)
                 )
+            ) from err
+    return words
+
+
+def bulk_encode(tokens, isa, tags, constants):
+    ''' Encodes a token stream or ``Program`` with NumPy array operations
+
+    Instructions are grouped by mnemonic straight from the ``ops`` and
+    ``operands`` columns of the program, whose ``strings`` table already
+    interns every distinct argument. Then each field is computed for a
+    whole group at once: its distinct arguments are resolved, and the
+    values are gathered, shifted and or-ed into the words. Returns a
+    ``uint32`` array, or ``uint64`` for instructions wider than 32 bits.
+    Fields take the final value of their symbols, so a program that
+    defines a symbol more than once is encoded by ``encode_program``
+    instead. Needs numpy.
+    '''
+    import numpy
+
+    ins_len = isa['_config']['ins_len']
+    if ins_len > 64:
+        raise Exception(
+            'Bulk encoding supports up to 64 bit instructions, not {}'.format(
+                ins_len
             )
         )
-        m_dir = os.path.dirname(m_path)
-        sys.path.insert(0, m_dir)
-        m_name = os.path.basename(m_path).split('.')[0]
-        macro_module = import_module(m_name)
-        macros_dict = macro_module.init_macros()
+    program = tokens if isinstance(tokens, Program) else Program(isa, tokens)
+    defined = [symbol[2] for symbol in program.symbols]
+    if len(set(defined)) != len(defined):
+        return numpy.array(
+            encode_program(program, tags, constants),
+            dtype=numpy.uint32 if ins_len <= 32 else numpy.uint64
+        )
+    for _, kind, name, value in program.symbols:
+        (tags if kind == 'label' else constants)[name] = value
+    ops = numpy.frombuffer(program.ops, dtype=program.ops.typecode)
+    operands = numpy.frombuffer(
+        program.operands, dtype=program.operands.typecode
+    )
+    counts = numpy.array(
+        [isa[name][1] for name in program.names], dtype=numpy.intp
+    )[ops]
+    starts = numpy.cumsum(counts) - counts
 
-    if asm_dict:
-        asm_tree = eval(asm_dict.read().decode('utf-8'))
-    else:
-        asm_tree = DEFAULT_INS
-
-    text = filename.read().decode('utf-8')
-    text = re.sub(r'(?m)^\s*#.*\n?', '', text).splitlines()
-    clean_text = []
-    for line in text:
-        clean_text.append(re.sub(r'\s', '', line))
-    if macros:
-        expanded_text = expand_macro(clean_text, macros_dict)
-    else:
-        expanded_text = clean_text
-    resolve_symbols(expanded_text)
-    bytecode, asm_ins = asemble(expanded_text, asm_tree)
-    bytecode = [
-        ''.join(
-            ["{}'b".format(asm_tree['_config']['ins_len']), line]
-        ) for line in bytecode
+    words = numpy.zeros(len(ops), dtype=numpy.uint64)
+    for op in numpy.unique(ops).tolist():
+        name = program.names[op]
+        opword, _, fields = isa[name]
+        indices = numpy.flatnonzero(ops == op)
+        packed = numpy.full(len(indices), opword, dtype=numpy.uint64)
+        for position, (kind, shift, mask) in enumerate(fields):
+            column = operands[starts[indices] + position]
+            distinct, inverse = numpy.unique(column, return_inverse=True)
+            values = []
+            for arg_id in distinct.tolist():
+                arg = program.strings[arg_id]
+                try:
+                    values.append(check_field(
+                        map_args(kind, arg, tags, constants), mask, arg
+                    ))
+                except Exception as err:
+                    raise Exception(
+                        '{}: Unable to parse args on instruction: {}'.format(
+                            program.lines[
+                                indices[numpy.argmax(column == arg_id)]
+                            ], name
+                        )
+                    ) from err
+            packed |= numpy.array(values, dtype=numpy.uint64)[inverse] << (
+                numpy.uint64(shift)
+            )
+        words[indices] = packed
+    return words.astype(numpy.uint32) if ins_len <= 32 else words
+
+
+def asemble(tokens, asm_def, tags, constants, memo=None):
+    ''' Encodes every instruction token, see ``assemble_tokens``
+
+    Returns the words and the text of every instruction.
+    '''
+    tokens = list(tokens)
+    bytecode = assemble_tokens(
+        tokens, compile_isa(asm_def), tags, constants, memo
+    )
+    return bytecode, [
+        token_text(token) for token in tokens if token.kind == 'ins'
     ]
-    output.write(ROM_TEMPLATE.render(
-                asm=bytecode,
-                addr_len=asm_tree['_config']['addr_len']-1,
-                ins_len=asm_tree['_config']['ins_len']-1,
-                asm_ins=asm_ins
+
+
+# Register operands read and written by the default instructions, by index
+# into their arguments. They only apply to an instruction whose fields have
+# the same kinds as in DEFAULT_INS, 'reg' standing for 'arg'. Other
+# instructions end every store analysis.
+EFFECTS = {
+    'NOP': ((), ()),
+    'LED': ((0,), ()),
+    'BLE': ((1, 2), ()),
+    'STO': ((), (0,)),
+    'ADD': ((1, 2), (0,)),
+    'JMP': ((), ()),
+}
+
+
+def optimize(tokens, asm_def=None):
+    ''' Removes useless instructions from a token stream
+
+    Builds the control flow graph of the program from its ``BRANCHES``
+    (``JMP`` being the only unconditional one) and, until nothing changes:
+
+    * threads branches to a ``JMP`` straight to its final target,
+    * removes branches to the next instruction,
+    * removes the blocks not reachable from the first instruction or from a
+      label used as a value,
+    * removes, inside each block, stores of the value a register already
+      holds and stores overwritten before being read, see ``EFFECTS``.
+
+    Labels are left in place, to be resolved again when the result is
+    assembled. Programs with a branch to a number or constant, or a label
+    defined twice, are returned unchanged. Returns the tokens and a dict
+    with the count of each change, the ``words`` saved and the ``cycles``
+    saved per execution of the changed instructions.
+    '''
+    asm_def = DEFAULT_INS if asm_def is None else asm_def
+    tokens = list(tokens)
+    saved = OrderedDict(
+        (key, 0) for key in ('threaded', 'jumps', 'dead', 'stores',
+                             'words', 'cycles')
+    )
+    branches = {
+        name: index for name, index in BRANCHES.items() if name in asm_def
+    }
+    kinds = {
+        name: [kind for kind, _ in isa_args(ins) if kind != 'zero']
+        for name, ins in asm_def.items() if name != '_config'
+    }
+    effects = {
+        name: effect for name, effect in EFFECTS.items()
+        if name in kinds and [
+            'arg' if kind == 'reg' else kind for kind in kinds[name]
+        ] == [
+            kind for kind, _ in isa_args(DEFAULT_INS[name]) if kind != 'zero'
+        ]
+    }
+    tags = {}
+    constants = {}
+    size = resolve_symbols(tokens, tags, constants)
+    labels = [token.name for token in tokens if token.kind == 'label']
+    instructions = [token for token in tokens if token.kind == 'ins']
+    if len(set(labels)) != len(labels) or any(
+            len(token.args) != len(kinds.get(token.name, (None,)))
+            or token.name in branches
+            and token.args[branches[token.name]] not in tags
+            for token in instructions):
+        return tokens, saved
+
+    values = {}
+    registers = {}
+
+    def value_of(kind, arg):
+        key = (kind, arg)
+        if key not in values:
+            values[key] = None
+            if arg not in tags:
+                try:
+                    values[key] = map_args(kind, arg, tags, constants)
+                except Exception:
+                    pass
+        return values[key]
+
+    changed = True
+    while changed:
+        changed = False
+        # token index of the instruction each label points to and of the
+        # instruction after each one, len(tokens) past the end
+        where = {}
+        pending = []
+        for index, token in enumerate(tokens):
+            if token.kind == 'label':
+                pending.append(token.name)
+            elif pending and token.kind == 'ins':
+                where.update((name, index) for name in pending)
+                pending = []
+        where.update((name, len(tokens)) for name in pending)
+        instructions = [
+            index for index, token in enumerate(tokens) if token.kind == 'ins'
+        ]
+        following = dict(zip(instructions, instructions[1:] + [len(tokens)]))
+        removed = set()
+
+        for index, token in enumerate(tokens):
+            if token.kind != 'ins' or token.name not in branches:
+                continue
+            field = branches[token.name]
+            target = token.args[field]
+            seen = {target}
+            while where[target] < len(tokens):
+                jump = tokens[where[target]]
+                if jump.name != 'JMP' or jump.args[branches['JMP']] in seen:
+                    break
+                target = jump.args[branches['JMP']]
+                seen.add(target)
+            if target != token.args[field]:
+                args = list(token.args)
+                args[field] = target
+                tokens[index] = token = token._replace(args=tuple(args))
+                saved['threaded'] += 1
+                saved['cycles'] += len(seen) - 1
+                changed = True
+            if where[target] == following[index]:
+                removed.add(index)
+                saved['jumps'] += 1
+                saved['cycles'] += 1
+
+        used = set(
+            arg for token in tokens if token.kind == 'ins'
+            for field, arg in enumerate(token.args)
+            if arg in tags and branches.get(token.name) != field
+        )
+        stack = [where[name] for name in used]
+        stack.append(instructions[0] if instructions else len(tokens))
+        reachable = set()
+        while stack:
+            index = stack.pop()
+            if index in reachable or index >= len(tokens):
+                continue
+            reachable.add(index)
+            token = tokens[index]
+            if token.name in branches:
+                stack.append(where[token.args[branches[token.name]]])
+            if token.name != 'JMP':
+                stack.append(following[index])
+        dead = set(following) - reachable - removed
+        removed |= dead
+        saved['dead'] += len(dead)
+
+        known = {}
+        stores = {}
+        for index, token in enumerate(tokens):
+            if token.kind == 'label':
+                known = {}
+                stores = {}
+            if token.kind != 'ins' or index in removed:
+                continue
+            reads, writes = effects.get(token.name, (None, None))
+            key = (token.name, token.args)
+            operands = registers.get(key)
+            if operands is None and reads is not None:
+                operands = registers[key] = [
+                    value_of(kinds[token.name][field], token.args[field])
+                    for field in reads + writes
+                ]
+            if operands is None or None in operands:
+                known = {}
+                stores = {}
+                continue
+            for operand in operands[:len(reads)]:
+                stores.pop(operand, None)
+            for operand in operands[len(reads):]:
+                if token.name == 'STO':
+                    value = value_of('value', token.args[1])
+                    if value is not None and known.get(operand) == value:
+                        removed.add(index)
+                        saved['stores'] += 1
+                        saved['cycles'] += 1
+                        break
+                if operand in stores:
+                    removed.add(stores.pop(operand))
+                    saved['stores'] += 1
+                    saved['cycles'] += 1
+                if token.name == 'STO':
+                    stores[operand] = index
+                    known[operand] = value
+                else:
+                    known.pop(operand, None)
+            if token.name in branches:
+                stores = {}
+                if token.name == 'JMP':
+                    known = {}
+
+        if removed:
+            tokens = [
+                token for index, token in enumerate(tokens)
+                if index not in removed
+            ]
+            changed = True
+
+    saved['words'] = size - sum(token.kind == 'ins' for token in tokens)
+    return tokens, saved
+
+
+def write_lines(output, lines, chunk_size=4096):
+    ''' Writes text lines to a binary file in chunks of ``chunk_size`` '''
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) == chunk_size:
+            output.write(''.join(chunk).encode('utf-8'))
+            chunk = []
+    output.write(''.join(chunk).encode('utf-8'))
+
+
+def write_rom(output, words, config, chunk_size=4096):
+    ''' Writes the ROM module to a binary file
+
+    Produces the same bytes as rendering ``ROM_TEMPLATE``. Case arms are
+    formatted and written in chunks of ``chunk_size`` words; ``words`` may
+    be any iterable of encoded instructions, so the module can be emitted
+    while the program is still being assembled.
+    '''
+    case = ROM_CASE.format(
+        '{}', "{0}'b{{:0{0}b}}".format(config['ins_len'])
+    )
+    output.write(ROM_HEADER.format(
+        addr_len=config['addr_len'] - 1,
+        ins_len=config['ins_len'] - 1,
     ).encode('utf-8'))
+    write_lines(
+        output,
+        (case.format(address, word) for address, word in enumerate(words)),
+        chunk_size
+    )
+    output.write(ROM_FOOTER.encode('utf-8'))
+
+
+def write_memh(output, words, config, chunk_size=4096):
+    ''' Writes a ``$readmemh`` image, one hexadecimal word per line '''
+    line = '{{:0{}x}}\n'.format((config['ins_len'] + 3) // 4)
+    write_lines(output, (line.format(word) for word in words), chunk_size)
+
+
+def write_memb(output, words, config, chunk_size=4096):
+    ''' Writes a ``$readmemb`` image, one binary word per line '''
+    line = '{{:0{}b}}\n'.format(config['ins_len'])
+    write_lines(output, (line.format(word) for word in words), chunk_size)
+
+
+def iter_bytes(words, config, chunk_size=4096):
+    ''' Yields words packed big endian in ``(ins_len + 7) // 8`` bytes
+
+    NumPy arrays from ``bulk_encode``, and ``array`` words of the right
+    size, are packed with array operations.
+    '''
+    width = (config['ins_len'] + 7) // 8
+    if hasattr(words, 'dtype'):
+        for start in range(0, len(words), chunk_size):
+            packed = words[start:start + chunk_size].astype('>u8')
+            yield packed.view('u1').reshape(-1, 8)[:, 8 - width:].tobytes()
+        return
+    if getattr(words, 'itemsize', None) == width:
+        for start in range(0, len(words), chunk_size):
+            packed = words[start:start + chunk_size]
+            if sys.byteorder == 'little':
+                packed.byteswap()
+            yield packed.tobytes()
+        return
+    chunk = []
+    for word in words:
+        chunk.append(word.to_bytes(width, 'big'))
+        if len(chunk) == chunk_size:
+            yield b''.join(chunk)
+            chunk = []
+    yield b''.join(chunk)
+
+
+def write_bin(output, words, config, chunk_size=4096):
+    ''' Writes a raw binary image of big endian packed words '''
+    for data in iter_bytes(words, config, chunk_size):
+        output.write(data)
+
+
+def ihex_record(kind, address, data):
+    record = bytes((len(data), address >> 8, address & 0xff, kind)) + data
+    return ':{}{:02X}\n'.format(
+        record.hex().upper(), -sum(record) & 0xff
+    )
+
+
+def write_ihex(output, words, config, chunk_size=4096):
+    ''' Writes an Intel HEX image of big endian packed words
+
+    Data goes in 16 byte records, with an extended linear address record
+    every time the image crosses a 64KiB boundary.
+    '''
+    address = 0
+    pending = b''
+    lines = []
+    for data in iter_bytes(words, config, chunk_size):
+        pending += data
+        offset = 0
+        while len(pending) - offset >= 16:
+            if address & 0xffff == 0 and address:
+                lines.append(ihex_record(4, 0, address.to_bytes(4, 'big')[:2]))
+            lines.append(
+                ihex_record(0, address & 0xffff, pending[offset:offset + 16])
+            )
+            address += 16
+            offset += 16
+        pending = pending[offset:]
+        output.write(''.join(lines).encode('ascii'))
+        lines = []
+    if pending:
+        if address & 0xffff == 0 and address:
+            lines.append(ihex_record(4, 0, address.to_bytes(4, 'big')[:2]))
+        lines.append(ihex_record(0, address & 0xffff, pending))
+    lines.append(ihex_record(1, 0, b''))
+    output.write(''.join(lines).encode('ascii'))
+
+
+def write_rom_wrapper(output, image, size, config, readmem='$readmemh'):
+    ''' Writes a ROM module that loads its words from an image file '''
+    output.write(ROM_WRAPPER.format(
+        addr_len=config['addr_len'] - 1,
+        ins_len=config['ins_len'] - 1,
+        last=max(size, 1) - 1,
+        size=size,
+        image=image,
+        readmem=readmem,
+    ).encode('utf-8'))
+
+
+WRITERS = {
+    'rom': write_rom,
+    'memh': write_memh,
+    'memb': write_memb,
+    'bin': write_bin,
+    'ihex': write_ihex,
+}
+
+EXTENSIONS = {
+    'rom': '.v',
+    'memh': '.hex',
+    'memb': '.mem',
+    'bin': '.bin',
+    'ihex': '.ihex',
+}
+
+
+ROM_CASE_RE = re.compile(
+    rb'^[ \t]*(\d+)[ \t]*:[ \t]*oInstruction[ \t]*=[ \t]*([^;\s]+)[ \t]*;',
+    re.M
+)
+
+# Mnemonics whose field at the given index is a jump target
+BRANCHES = {'JMP': 0, 'BLE': 0}
+
+
+def place_words(pairs):
+    ''' Builds a word list from ``(address, word)`` pairs, zero filling gaps
+    '''
+    words = []
+    for address, word in pairs:
+        if address >= len(words):
+            words.extend([0] * (address + 1 - len(words)))
+        words[address] = word
+    return words
+
+
+def read_rom(data, config=None):
+    ''' Reads the words of a ROM module written by ``write_rom`` '''
+    values = {}
+    pairs = []
+    for address, value in ROM_CASE_RE.findall(data):
+        word = values.get(value)
+        if word is None:
+            word = values[value] = str2int(value.decode('ascii'))
+        pairs.append((int(address), word))
+    return place_words(pairs)
+
+
+def read_image(data, base):
+    ''' Reads a ``$readmemh`` or ``$readmemb`` image
+
+    Words are separated by white space, ``//`` comments are skipped and
+    ``@address`` entries, in hexadecimal, move the load address.
+    '''
+    if b'@' not in data and b'//' not in data:
+        return [int(item, base) for item in data.split()]
+    pairs = []
+    address = 0
+    for line in data.decode('ascii').splitlines():
+        for item in line.split('//', 1)[0].split():
+            if item.startswith('@'):
+                address = int(item[1:], 16)
+                continue
+            pairs.append((address, int(item.replace('_', ''), base)))
+            address += 1
+    return place_words(pairs)
+
+
+def read_memh(data, config=None):
+    ''' Reads the words of a ``$readmemh`` image, see ``read_image`` '''
+    return read_image(data, 16)
+
+
+def read_memb(data, config=None):
+    ''' Reads the words of a ``$readmemb`` image, see ``read_image`` '''
+    return read_image(data, 2)
+
+
+def read_bin(data, config):
+    ''' Reads the words of a raw image of big endian packed words '''
+    width = (config['ins_len'] + 7) // 8
+    if len(data) % width:
+        raise Exception(
+            'Image size {} is not a multiple of the {} byte word'.format(
+                len(data), width
+            )
+        )
+    return [
+        int.from_bytes(data[start:start + width], 'big')
+        for start in range(0, len(data), width)
+    ]
+
+
+def read_ihex(data, config):
+    ''' Reads the words of an Intel HEX image written by ``write_ihex`` '''
+    image = bytearray()
+    base = 0
+    for number, line in enumerate(data.decode('ascii').splitlines(), 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = bytes.fromhex(line[1:])
+        except ValueError:
+            record = b''
+        if (not line.startswith(':') or len(record) < 5
+                or len(record) != record[0] + 5 or sum(record) & 0xff):
+            raise Exception('{}: Invalid Intel HEX record'.format(number))
+        kind = record[3]
+        payload = record[4:-1]
+        if kind == 0:
+            address = base + (record[1] << 8 | record[2])
+            if address > len(image):
+                image.extend(bytes(address - len(image)))
+            image[address:address + len(payload)] = payload
+        elif kind == 4:
+            base = int.from_bytes(payload, 'big') << 16
+        elif kind == 1:
+            break
+    return read_bin(bytes(image), config)
+
+
+READERS = {
+    'rom': read_rom,
+    'memh': read_memh,
+    'memb': read_memb,
+    'bin': read_bin,
+    'ihex': read_ihex,
+}
+
+
+def disassemble(words, asm_def=None, branches=BRANCHES):
+    ''' Yields the source lines of a program from its encoded words
+
+    Words are decoded with ``compile_decoder``. ``reg`` and ``arg`` fields
+    below ``REGISTERS`` are written as registers and the rest as numbers,
+    except the target fields of ``branches``, which are numbers, or an
+    ``L<address>`` label when they point inside the program. Words that
+    match no instruction are written as comments; otherwise assembling the
+    result gives back the same words.
+    '''
+    asm_def = DEFAULT_INS if asm_def is None else asm_def
+    decoder = compile_decoder(asm_def)
+    kinds = {
+        name: [kind for kind, _ in isa_args(ins) if kind != 'zero']
+        for name, ins in asm_def.items() if name != '_config'
+    }
+    decoded = {}
+    targets = set()
+    for word in words:
+        if word not in decoded:
+            decoded[word] = decode(decoder, word)
+            if decoded[word] is not None:
+                name, values = decoded[word]
+                if name in branches and values[branches[name]] < len(words):
+                    targets.add(values[branches[name]])
+
+    lines = {}
+    for address, word in enumerate(words):
+        if address in targets:
+            yield 'L{}:'.format(address)
+        line = lines.get(word)
+        if line is None:
+            if decoded[word] is None:
+                line = '    # unknown instruction {:#x}'.format(word)
+            else:
+                name, values = decoded[word]
+                target = branches.get(name)
+                args = [
+                    'R{}'.format(value)
+                    if kind == 'reg' or kind == 'arg' and
+                    value < REGISTERS and field != target
+                    else str(value)
+                    for field, (kind, value) in enumerate(
+                        zip(kinds[name], values)
+                    )
+                ]
+                if target is not None and values[target] in targets:
+                    args[target] = 'L{}'.format(values[target])
+                line = '    {} {}'.format(name, ', '.join(args)).rstrip()
+            lines[word] = line
+        yield line
+
+
+def iter_source(source):
+    ''' Yields the decoded lines of a binary file '''
+    for line in source:
+        yield line.decode('utf-8')
+
+
+def stream_asemble(source, output, asm_def, macros_dict=None,
+                   writer=write_rom):
+    ''' Assembles a seekable binary file straight into a ROM module
+
+    A first pass over ``source`` collects labels and constants, then a
+    second pass, which updates them as they are redefined, so references
+    resolve as in ``assemble_tokens``, encodes every instruction as it is
+    read and hands it to
+    ``writer``, so memory use does not grow with the program. The file is
+    scanned through ``map_source`` when it can be mapped. Returns the
+    number of instructions written.
+    '''
+    isa = compile_isa(asm_def)
+    data = map_source(source)
+
+    def tokens():
+        if data is not None:
+            return expand_macro(scan_source(data), macros_dict)
+        source.seek(0)
+        return expand_macro(tokenize(iter_source(source)), macros_dict)
+
+    def words():
+        address = 0
+        for token in tokens():
+            if token.kind == 'ins':
+                yield encode_token(isa, token, tags, constants)
+                address += 1
+            elif token.kind == 'label':
+                tags[token.name] = address
+            elif token.kind == 'const':
+                constants[token.name] = parse_constant(token)
+
+    tags = {}
+    constants = {}
+    try:
+        size = resolve_symbols(tokens(), tags, constants)
+        writer(output, words(), isa['_config'])
+    except BaseException:
+        if data is not None:
+            release_source(data)
+        raise
+    if data is not None:
+        data.close()
+    return size
+
+
+def read_lines(source, chunk_size=1 << 16):
+    ''' Yields the contents of a binary file in pieces ending at line ends
+
+    Takes what is available, up to ``chunk_size`` bytes at a time, so lines
+    coming down a pipe are passed on without waiting for a full chunk.
+    '''
+    read = getattr(source, 'read1', source.read)
+    rest = b''
+    while True:
+        data = read(chunk_size)
+        if not data:
+            break
+        end = data.rfind(b'\n') + 1
+        if not end:
+            rest += data
+            continue
+        yield rest + data[:end]
+        rest = data[end:]
+    if rest:
+        yield rest
+
+
+def pipe_stage(items, depth=8):
+    ''' Iterates ``items`` in a thread, handing them over a bounded queue
+
+    The thread blocks once ``depth`` items wait to be taken, so a slow
+    consumer holds back the stages before it. Exceptions raised by
+    ``items`` are raised again in the consumer, and closing the generator
+    stops the thread and closes ``items``.
+    '''
+    import queue
+    import threading
+    handoff = queue.Queue(depth)
+    stop = threading.Event()
+    done = object()
+
+    def put(entry):
+        while not stop.is_set():
+            try:
+                handoff.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if not put((item, None)):
+                    return
+        except BaseException as err:
+            put((done, err))
+        else:
+            put((done, None))
+        finally:
+            close = getattr(items, 'close', None)
+            if close:
+                close()
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            item, error = handoff.get()
+            if item is done:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+
+
+def pipe_encode(batches, isa, tags, constants, memo_size=1 << 16):
+    ''' Encodes lists of tokens, yielding lists of words ready to be written
+
+    Works like ``assemble_tokens``, but a field naming a symbol not defined
+    yet is patched as soon as the symbol is defined, and only the words
+    from the first unpatched one on are held back until then. Since a
+    forward reference takes the first definition of its symbol, the output
+    matches ``assemble_tokens`` without waiting for the end. Instructions
+    that needed no patch are memoized, dropping the memo whenever it holds
+    ``memo_size`` of them.
+    '''
+    from collections import deque
+    words = []
+    base = 0
+    blocked = {}
+    order = deque()
+    waiting = {}
+    pending = []
+
+    def patch(address, shift, mask, symbol, token):
+        try:
+            value = map_args('value', symbol, tags, constants)
+            words[address - base] |= check_field(value, mask, symbol) << shift
+        except Exception as err:
+            raise Exception(
+                '{}:{}: Unable to parse'
+                ' args on instruction: {}'.format(
+                    token.line, token.column, token_text(token)
+                )
+            ) from err
+
+    memo = {}
+    for batch in batches:
+        for token in batch:
+            if token.kind == 'ins':
+                key = (token.name, token.args)
+                word = memo.get(key)
+                if word is None:
+                    word = encode_token(isa, token, tags, constants, pending)
+                    if not pending:
+                        if len(memo) >= memo_size:
+                            memo.clear()
+                        memo[key] = word
+                words.append(word)
+                if pending:
+                    address = base + len(words) - 1
+                    blocked[address] = len(pending)
+                    order.append(address)
+                    for shift, mask, symbol in pending:
+                        waiting.setdefault(symbol, []).append(
+                            (address, shift, mask, symbol, token)
+                        )
+                    del pending[:]
+                continue
+            if token.name in tags or token.name in constants:
+                memo.clear()
+            if token.kind == 'label':
+                tags[token.name] = base + len(words)
+            else:
+                constants[token.name] = parse_constant(token)
+            for fixup in waiting.pop(token.name, ()):
+                patch(*fixup)
+                blocked[fixup[0]] -= 1
+                if not blocked[fixup[0]]:
+                    del blocked[fixup[0]]
+        while order and order[0] not in blocked:
+            order.popleft()
+        ready = order[0] - base if order else len(words)
+        if ready:
+            yield words[:ready]
+            del words[:ready]
+            base += ready
+
+    if waiting:
+        patch(*min(fixup for fixups in waiting.values() for fixup in fixups))
+    if words:
+        yield words
+
+
+def pipe_asemble(source, output, asm_def, macros_dict=None,
+                 writer=write_rom, batch_size=4096, depth=8):
+    ''' Assembles a binary stream, such as a pipe, as it comes in
+
+    Reading and tokenizing, encoding with ``pipe_encode`` and writing run
+    as three stages, the first two in their own threads, joined by queues
+    of at most ``depth`` batches of ``batch_size`` tokens or words. Waiting
+    for input or output overlaps with the work of the other stages, and a
+    slow reader of ``output`` stalls the whole pipeline instead of letting
+    it queue up the program. Returns the number of instructions written.
+    '''
+    from itertools import chain, islice
+    isa = compile_isa(asm_def)
+
+    def tokens():
+        number = 1
+        for data in read_lines(source):
+            yield from scan_source(data, number)
+            number += data.count(b'\n')
+
+    def batches(items):
+        items = iter(items)
+        while True:
+            batch = list(islice(items, batch_size))
+            if not batch:
+                return
+            yield batch
+
+    sizes = []
+
+    def counted(items):
+        for batch in items:
+            sizes.append(len(batch))
+            yield batch
+
+    words = pipe_stage(pipe_encode(
+        pipe_stage(batches(expand_macro(tokens(), macros_dict)), depth),
+        isa, {}, {}
+    ), depth)
+    try:
+        writer(output, chain.from_iterable(counted(words)), isa['_config'])
+    finally:
+        words.close()
+    return sum(sizes)
+
+
+Object = namedtuple(
+    'Object', ['name', 'words', 'relocs', 'tags', 'constants', 'earliest']
+)
+
+
+def load_macros(path, reload=False):
+    ''' Imports a macro module by path and returns its macro definitions
+
+    With ``reload`` an already imported module is read again from disk.
+    '''
+    from importlib import import_module
+    m_path = os.path.abspath(
+        os.path.expandvars(
+            os.path.expanduser(
+                path
+            )
+        )
+    )
+    m_dir = os.path.dirname(m_path)
+    if m_dir not in sys.path:
+        sys.path.insert(0, m_dir)
+    m_name = os.path.basename(m_path).split('.')[0]
+    if reload and m_name in sys.modules:
+        from importlib import reload as reload_module
+        macro_module = reload_module(sys.modules[m_name])
+    else:
+        macro_module = import_module(m_name)
+    return macro_module.init_macros(), macro_module.__file__
+
+
+def assemble_object(name, data, asm_def, macros=None):
+    ''' Assembles one source file of a multi-file program
+
+    Labels and constants go to per-file tables in a single pass, and
+    references resolve as in ``assemble_tokens``. A reference to a label
+    of the file is left for ``link`` as a relocation ``(index, shift, mask,
+    symbol, line, address)`` to add the base of the file to, and one to a
+    symbol the file does not define has ``None`` as address. ``earliest``
+    holds the first definition of each symbol as ``(kind, value)``.
+    ``macros`` is the path of a macro module, so this can run in a worker
+    process.
+    '''
+    isa = compile_isa(asm_def)
+    tokens = expand_macro(
+        tokenize(data.decode('utf-8').splitlines()),
+        load_macros(macros)[0] if macros else None
+    )
+    tags = {}
+    constants = {}
+    earliest = {}
+    words = []
+    relocs = []
+    waiting = {}
+    pending = []
+    for token in tokens:
+        if token.kind != 'ins':
+            if token.kind == 'label':
+                value = tags[token.name] = len(words)
+            else:
+                value = constants[token.name] = parse_constant(token)
+            earliest.setdefault(token.name, (token.kind, value))
+            for index, shift, mask, line in waiting.pop(token.name, ()):
+                if token.kind == 'label':
+                    relocs.append((index, shift, mask, token.name, line,
+                                   value))
+                    continue
+                try:
+                    words[index] |= check_field(
+                        value, mask, token.name
+                    ) << shift
+                except Exception as err:
+                    raise Exception(
+                        '{}:{}: {}'.format(name, line, err)
+                    ) from err
+            continue
+        words.append(encode_token(isa, token, None, constants, pending))
+        for shift, mask, symbol in pending:
+            if symbol in tags:
+                relocs.append((len(words) - 1, shift, mask, symbol,
+                               token.line, tags[symbol]))
+            else:
+                waiting.setdefault(symbol, []).append(
+                    (len(words) - 1, shift, mask, token.line)
+                )
+        del pending[:]
+    for symbol, references in waiting.items():
+        for index, shift, mask, line in references:
+            relocs.append((index, shift, mask, symbol, line, None))
+    relocs.sort(key=lambda reloc: reloc[:3])
+    return Object(name, words, relocs, tags, constants, earliest)
+
+
+def link(objects):
+    ''' Lays out objects one after another and patches their relocations
+
+    Relocations to a label of their own object get its base added, the rest
+    resolve to the symbols exported by exactly one of the other objects: its
+    last definition if that object comes first, else its first one, as in
+    the concatenation of the sources. Returns the words of the whole
+    program.
+    '''
+    exported = {}
+    bases = []
+    base = 0
+    for position, obj in enumerate(objects):
+        bases.append(base)
+        for symbol in obj.earliest:
+            exported.setdefault(symbol, []).append(position)
+        base += len(obj.words)
+
+    def value_of(position, symbol, first):
+        obj = objects[position]
+        if first:
+            kind, value = obj.earliest[symbol]
+        elif symbol in obj.tags:
+            kind, value = 'label', obj.tags[symbol]
+        else:
+            kind, value = 'const', obj.constants[symbol]
+        return value + bases[position] if kind == 'label' else value
+
+    words = []
+    for position, (obj, base) in enumerate(zip(objects, bases)):
+        obj_words = list(obj.words)
+        for index, shift, mask, symbol, line, address in obj.relocs:
+            if address is not None:
+                value = address + base
+            elif symbol in exported and len(exported[symbol]) == 1:
+                owner = exported[symbol][0]
+                value = value_of(owner, symbol, owner > position)
+            elif symbol in exported:
+                raise Exception(
+                    '{}:{}: Symbol {} is defined in {}'.format(
+                        obj.name, line, symbol, ', '.join(
+                            objects[owner].name
+                            for owner in exported[symbol]
+                        )
+                    )
+                )
+            else:
+                raise Exception('{}:{}: Undefined Symbol: {}'.format(
+                    obj.name, line, symbol
+                ))
+            try:
+                value = check_field(value, mask, symbol)
+            except Exception as err:
+                raise Exception(
+                    '{}:{}: {}'.format(obj.name, line, err)
+                ) from err
+            obj_words[index] |= value << shift
+        words.extend(obj_words)
+    return words
+
+
+def _assemble_object(args):
+    return assemble_object(*args)
+
+
+def assemble_files(sources, asm_def, macros=None, jobs=1):
+    ''' Assembles ``(name, data)`` sources in parallel and links them
+
+    Files are assembled on a pool of ``jobs`` processes (all cores when
+    ``jobs`` is 0), or in this process when ``jobs`` is 1.
+    '''
+    work = [(name, data, asm_def, macros) for name, data in sources]
+    if jobs == 1 or len(work) == 1:
+        objects = [_assemble_object(args) for args in work]
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(jobs or None) as pool:
+            objects = list(pool.map(_assemble_object, work))
+    return link(objects)
+
+
+# Program and final symbol tables of the running parallel_encode, inherited
+# by its worker processes
+_PARALLEL = None
+
+
+def _init_parallel(state):
+    global _PARALLEL
+    _PARALLEL = state
+
+
+def _encode_chunk(bounds):
+    # runs in the workers, set up by _init_parallel
+    program, tags, constants = _PARALLEL
+    return encode_program(program, tags, constants, *bounds)
+
+
+def parallel_encode(tokens, isa, tags, constants, jobs=0, chunk_size=None):
+    ''' Encodes a token stream or ``Program`` on a pool of processes
+
+    The instructions are split in chunks of ``chunk_size``, and the operand
+    counts of the chunks are prefix-summed to find where the operands of
+    each one start. With the final symbol tables, taken from the program,
+    the chunks are encoded independently by ``jobs`` processes (all cores
+    when 0). The words are the ones ``encode_program`` returns, which is
+    used instead when a symbol is defined more than once, since the value
+    taken by a reference then depends on where it appears.
+    '''
+    program = tokens if isinstance(tokens, Program) else Program(isa, tokens)
+    jobs = jobs or os.cpu_count() or 1
+    if not chunk_size:
+        chunk_size = max(len(program) // (jobs * 4) + 1, 16384)
+
+    names = [symbol[2] for symbol in program.symbols]
+    if len(set(names)) != len(names):
+        return encode_program(program, tags, constants)
+    for _, kind, name, value in program.symbols:
+        (tags if kind == 'label' else constants)[name] = value
+
+    arities = program.arities()
+    bounds = []
+    operand = 0
+    for start in range(0, len(program), chunk_size):
+        end = min(start + chunk_size, len(program))
+        bounds.append((start, end, operand))
+        operand += sum(arities[op] for op in program.ops[start:end])
+
+    if jobs == 1 or len(bounds) < 2:
+        chunks = (
+            encode_program(program, tags, constants, *chunk)
+            for chunk in bounds
+        )
+    else:
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        context = None
+        if 'fork' in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context('fork')
+        with ProcessPoolExecutor(
+                jobs, mp_context=context, initializer=_init_parallel,
+                initargs=((program, tags, constants),)
+        ) as pool:
+            chunks = list(pool.map(_encode_chunk, bounds))
+    words = encode_program(program, {}, {}, 0, 0)
+    for chunk in chunks:
+        words.extend(chunk)
+    return words
+
+
+class Stats(object):
+    ''' Collects the timings and counters of an assembler run
+
+    Wrap each stage in ``with stats.stage(name)`` and record sizes with
+    ``count``. ``report`` returns the stage times, counters, peak memory
+    and throughput as a dict, ``format`` as text, and ``trace`` as a
+    Chrome trace (``chrome://tracing``, Perfetto) JSON document.
+    '''
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = OrderedDict()
+        self.counters = OrderedDict()
+        self.events = []
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.stages[name] = self.stages.get(name, 0.0) + elapsed
+            self.events.append((name, start - self.start, elapsed))
+
+    def count(self, name, value):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def report(self):
+        total = time.perf_counter() - self.start
+        report = OrderedDict([
+            ('stages', OrderedDict(self.stages)),
+            ('total', total),
+            ('counters', OrderedDict(self.counters)),
+            ('peak_memory', peak_memory()),
+        ])
+        for name in ('lines', 'instructions'):
+            if name in self.counters and total:
+                report['{}_per_second'.format(name)] = (
+                    self.counters[name] / total
+                )
+        return report
+
+    def format(self):
+        report = self.report()
+        lines = ['{:<12} {:>10.3f}s'.format(name, seconds)
+                 for name, seconds in report['stages'].items()]
+        lines.append('{:<12} {:>10.3f}s'.format('total', report['total']))
+        lines.extend('{:<12} {:>10}'.format(name, value)
+                     for name, value in report['counters'].items())
+        for name in ('lines', 'instructions'):
+            if name + '_per_second' in report:
+                lines.append('{:<12} {:>10.0f}'.format(
+                    name + '/s', report[name + '_per_second']
+                ))
+        if report['peak_memory'] is not None:
+            lines.append('{:<12} {:>10.1f}MiB'.format(
+                'peak memory', report['peak_memory'] / 2 ** 20
+            ))
+        return '\n'.join(lines)
+
+    def trace(self):
+        events = [
+            {'name': name, 'ph': 'X', 'pid': os.getpid(), 'tid': 0,
+             'ts': start * 1e6, 'dur': elapsed * 1e6}
+            for name, start, elapsed in self.events
+        ]
+        return {'traceEvents': events, 'otherData': self.report()}
+
+
+def peak_memory():
+    ''' Returns the peak resident memory of the process in bytes, if known '''
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def stage(stats, name):
+    return stats.stage(name) if stats else nullcontext()
+
+
+class Assembler(object):
+    ''' Assembler for one instruction set
+
+    Owns the compiled instruction set and the macro definitions, while the
+    symbol tables are built anew on every call, so one instance can be
+    reused and shared between threads. The labels and constants of the last
+    program assembled are left in ``tags`` and ``constants``.
+
+    With a ``Stats`` object, tokens are collected before encoding so that
+    the ``tokenize``, ``assemble`` and ``write`` stages are timed apart.
+    Tables already built by ``compile_isa``, such as the ones returned by
+    ``load_isa``, can be passed as ``isa``. With ``optimize`` the tokens go
+    through ``optimize`` first, and what it saved is left in ``saved``.
+    '''
+
+    def __init__(self, asm_def=None, macros_dict=None, stats=None, isa=None,
+                 optimize=False):
+        self.asm_def = DEFAULT_INS if asm_def is None else asm_def
+        self.isa = compile_isa(self.asm_def) if isa is None else isa
+        self.config = self.asm_def['_config']
+        self.macros_dict = macros_dict
+        self.stats = stats
+        self.optimize = optimize
+        self.tags = {}
+        self.constants = {}
+        self.saved = None
+
+    def tokenize(self, text):
+        ''' Tokenizes a source string or lines, expanding macros
+
+        Bytes, and other buffers such as an ``mmap`` of the source file, are
+        scanned with ``scan_source``.
+        '''
+        if isinstance(text, str):
+            tokens = tokenize(text.splitlines())
+        elif hasattr(text, 'rfind'):
+            tokens = scan_source(text)
+        else:
+            tokens = tokenize(text)
+        return expand_macro(tokens, self.macros_dict)
+
+    def assemble(self, text):
+        ''' Assembles a source string, buffer or iterable of lines into words
+
+        Returns an ``array`` of words, see ``encode_program``.
+        '''
+        return self._assemble(text, encode_program)
+
+    def assemble_bulk(self, text):
+        ''' Like ``assemble``, returning a NumPy array, see ``bulk_encode`` '''
+        return self._assemble(
+            text, lambda program, tags, constants: bulk_encode(
+                program, self.isa, tags, constants
+            )
+        )
+
+    def assemble_parallel(self, text, jobs=0):
+        ''' Like ``assemble``, on many processes, see ``parallel_encode`` '''
+        return self._assemble(
+            text, lambda program, tags, constants: parallel_encode(
+                program, self.isa, tags, constants, jobs
+            )
+        )
+
+    def _assemble(self, text, encoder):
+        tags = {}
+        constants = {}
+        tokens = self.tokenize(text)
+        if self.optimize:
+            with stage(self.stats, 'tokenize'):
+                tokens = list(tokens)
+            with stage(self.stats, 'optimize'):
+                tokens, self.saved = optimize(tokens, self.asm_def)
+                program = Program(self.isa, tokens)
+            if self.stats:
+                self.stats.count('words_saved', self.saved['words'])
+                self.stats.count('cycles_saved', self.saved['cycles'])
+        else:
+            with stage(self.stats, 'tokenize'):
+                program = Program(self.isa, tokens)
+        if self.stats:
+            self.stats.count('tokens', len(program) + len(program.symbols))
+        with stage(self.stats, 'assemble'):
+            words = encoder(program, tags, constants)
+        if self.stats:
+            self.stats.count('instructions', len(words))
+            self.stats.count('labels', len(tags))
+            self.stats.count('constants', len(constants))
+        self.tags = tags
+        self.constants = constants
+        return words
+
+    def write(self, output, words, output_format='rom'):
+        ''' Writes words to a binary file in one of the ``WRITERS`` formats '''
+        with stage(self.stats, 'write'):
+            if hasattr(words, 'dtype') and output_format not in ('bin',
+                                                                 'ihex'):
+                words = words.tolist()
+            WRITERS[output_format](output, words, self.config)
+
+
+def sem_nop(sim):
+    pass
+
+
+def sem_led(sim, source):
+    sim.leds.append(sim.registers[source])
+
+
+def sem_ble(sim, target, source1, source0):
+    if sim.registers[source1] <= sim.registers[source0]:
+        return target
+
+
+def sem_sto(sim, destination, value):
+    sim.registers[destination] = value & sim.reg_mask
+
+
+def sem_add(sim, destination, source1, source0):
+    sim.registers[destination] = (
+        sim.registers[source1] + sim.registers[source0]
+    ) & sim.reg_mask
+
+
+def sem_jmp(sim, target):
+    return target
+
+
+SEMANTICS = {
+    'NOP': sem_nop,
+    'LED': sem_led,
+    'BLE': sem_ble,
+    'STO': sem_sto,
+    'ADD': sem_add,
+    'JMP': sem_jmp,
+}
+
+
+class Simulator(object):
+    ''' Instruction set simulator for assembled programs
+
+    Words are decoded once, with the decode table of the instruction set,
+    into ``(handler, operands)`` pairs. A handler is called with the
+    simulator and the instruction field values, and returns the address of
+    the next instruction or ``None`` to fall through. ``semantics`` extends
+    or overrides ``SEMANTICS`` by mnemonic.
+
+    Registers and memory are ``array`` objects of ``reg_len`` bits (16 by
+    default, see ``_config``). Every instruction takes one cycle, and values
+    written to the LEDs are collected in ``leds``.
+    '''
+
+    def __init__(self, words, asm_def=None, semantics=None, registers=256,
+                 memory=0):
+        from array import array
+        asm_def = DEFAULT_INS if asm_def is None else asm_def
+        self.semantics = dict(SEMANTICS)
+        self.semantics.update(semantics or {})
+        self.reg_mask = (1 << asm_def['_config'].get(
+            'reg_len', EXTRA_CONFIG['reg_len']
+        )) - 1
+        self.registers = array('Q', bytes(8 * registers))
+        self.memory = array('Q', bytes(8 * memory))
+        self.leds = []
+        self.pc = 0
+        self.cycles = 0
+        self.halted = False
+        self.program = self.predecode(words, compile_decoder(asm_def))
+
+    def predecode(self, words, decoder):
+        program = []
+        for address, word in enumerate(words):
+            decoded = decode(decoder, word)
+            if decoded is None or decoded[0] not in self.semantics:
+                program.append((self.illegal, (address, word)))
+            else:
+                program.append(
+                    (self.semantics[decoded[0]], tuple(decoded[1]))
+                )
+        return program
+
+    def illegal(self, sim, address, word):
+        raise Exception(
+            '{}: Unable to execute word {:#x}'.format(address, word)
+        )
+
+    def run(self, max_cycles=None):
+        ''' Runs until the program halts or ``max_cycles`` have elapsed
+
+        The program halts when the program counter leaves the ROM or an
+        instruction jumps to itself. Returns the number of cycles run.
+        '''
+        program = self.program
+        size = len(program)
+        pc = self.pc
+        start = cycles = self.cycles
+        limit = -1 if max_cycles is None else cycles + max_cycles
+        while cycles != limit:
+            if not 0 <= pc < size:
+                self.halted = True
+                break
+            handler, operands = program[pc]
+            target = handler(self, *operands)
+            cycles += 1
+            if target is None:
+                pc += 1
+            elif target == pc:
+                self.halted = True
+                break
+            else:
+                pc = target
+        self.pc = pc
+        self.cycles = cycles
+        return cycles - start
+
+
+def default_cache_dir():
+    return os.environ.get('MAASM_CACHE_DIR') or os.path.join(
+        os.path.expanduser('~'), '.cache', 'maasm'
+    )
+
+
+def digest(*parts):
+    import hashlib
+    sha = hashlib.sha1()
+    for part in parts:
+        sha.update(part if isinstance(part, bytes) else repr(part).encode())
+        sha.update(b'\0')
+    return sha.hexdigest()
+
+
+# Cache entries are dicts of plain values stored with marshal, which, unlike
+# pickle, can not run code when a tampered entry is loaded
+def load_cache(path):
+    import marshal
+    try:
+        with open(path, 'rb') as entry:
+            entry = marshal.load(entry)
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    return entry if isinstance(entry, dict) else None
+
+
+def save_cache(path, entry):
+    import marshal
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'wb') as cache_file:
+        marshal.dump(entry, cache_file)
+    os.replace(tmp, path)
+
+
+def load_isa(data, cache_dir=None):
+    ''' Parses an instruction set file, see ``parse_isa``
+
+    Returns ``(asm_def, isa)``, the validated dictionary and its compiled
+    tables. With a ``cache_dir`` the dictionary is stored there keyed by
+    the hash of ``data``, so later loads of the same file skip parsing and
+    validation and only compile it.
+    '''
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    path = cache_dir and os.path.join(
+        cache_dir, 'isa-{}.marshal'.format(digest(data, __version__))
+    )
+    asm_def = load_cache(path) if path else None
+    if asm_def is None:
+        asm_def = parse_isa(data)
+        if path:
+            try:
+                save_cache(path, asm_def)
+            except (OSError, ValueError):
+                pass
+    return asm_def, compile_isa(asm_def)
+
+
+def cached_asemble(data, asm_def, writer, key, cache_dir,
+                   macros_dict=None):
+    ''' Assembles ``data`` reusing the results of the previous build
+
+    ``key`` identifies the build (source path, instruction set, macros and
+    output format hashes). When the source is unchanged the cached output is
+    returned as is. Otherwise, if labels and constants still resolve to the
+    same values, only instructions not seen in the previous build are
+    encoded, and programs that redefine a symbol are always encoded in full.
+    The cache keeps the encodings of the current instructions only. Returns
+    the output bytes and the number of instructions.
+    '''
+    path = os.path.join(cache_dir, digest(key) + '.marshal')
+    source_hash = digest(data)
+    entry = load_cache(path)
+    if entry and entry['source'] == source_hash:
+        return entry['output'], entry['size']
+
+    tokens = list(expand_macro(
+        tokenize(data.decode('utf-8').splitlines()), macros_dict
+    ))
+    tags = {}
+    constants = {}
+    size = resolve_symbols(tokens, tags, constants)
+    symbols = digest(sorted(tags.items()), sorted(constants.items()))
+    defined = [token.name for token in tokens
+               if token.kind in ('label', 'const')]
+    if len(set(defined)) != len(defined):
+        # the value of a redefined symbol depends on where it is used
+        memo = None
+    elif entry and entry['symbols'] == symbols:
+        memo = entry['memo']
+    else:
+        memo = {}
+    bytecode, asm_ins = asemble(tokens, asm_def, tags, constants, memo)
+    # keep only what this build used, so edits do not pile up old variants
+    memo = {
+        key: memo[key] for key in
+        {(token.name, token.args) for token in tokens if token.kind == 'ins'}
+        if key in memo
+    } if memo else {}
+
+    output = io.BytesIO()
+    writer(output, bytecode, asm_def['_config'])
+    output = output.getvalue()
+    save_cache(path, {
+        'source': source_hash,
+        'symbols': symbols,
+        'memo': memo,
+        'output': output,
+        'size': size,
+    })
+    return output, size
+
+
+def _isa_option(asm_dict, cache_dir=None):
+    ''' Loads the instruction set given with --asm-dict, or the default one
+
+    Returns ``(asm_def, isa)`` as ``load_isa``, cached in ``cache_dir`` or
+    the default cache directory.
+    '''
+    import click
+    if not asm_dict:
+        return DEFAULT_INS, None
+    try:
+        return load_isa(asm_dict.read(), cache_dir or default_cache_dir())
+    except Exception as err:
+        raise click.BadParameter(describe_error(err), param_hint='--asm-dict')
+
+
+def _main(filenames, output, asm_dict, macros, stream, output_format,
+          rom_wrapper, cache, cache_dir, jobs, bulk, show_stats, profile,
+          optimize_code):
+    ''' Transforms from MiniAlu assembly to a verilog ROM module
+
+    FILENAMES: Input asm files, linked in the given order, or - to
+    assemble stdin as it is read
+
+    OUTPUT: Output verilog ROM module file, or memory image, - for stdout
+'''
+    import click
+    if rom_wrapper and output_format not in ('memh', 'memb'):
+        raise click.BadParameter(
+            'needs --format memh or memb', param_hint='--rom-wrapper'
+        )
+    name = getattr(output, 'name', None)
+    if rom_wrapper and (not isinstance(name, str) or
+                        name in ('-', '<stdout>')):
+        raise click.BadParameter(
+            'needs OUTPUT to be a file', param_hint='--rom-wrapper'
+        )
+    if cache and stream:
+        raise click.BadParameter(
+            'can not be used with --stream', param_hint='--cache'
+        )
+    if len(filenames) > 1 and (cache or stream or bulk):
+        raise click.BadParameter(
+            'takes a single FILENAME', param_hint='--cache/--stream/--bulk'
+        )
+    if optimize_code and (cache or stream or len(filenames) > 1):
+        raise click.BadParameter(
+            'takes a single FILENAME, without --cache or --stream',
+            param_hint='-O'
+        )
+    if bulk and (cache or stream or jobs != 1):
+        raise click.BadParameter(
+            'can not be used with --cache, --stream or --jobs',
+            param_hint='--bulk'
+        )
+    if bulk:
+        try:
+            import numpy  # noqa
+        except ImportError:
+            raise click.UsageError('--bulk needs numpy installed')
+    filename = filenames[0]
+
+    stats = Stats() if show_stats or profile else None
+    if profile and not profile.endswith('.json'):
+        import cProfile
+        profiler = cProfile.Profile()
+        click.get_current_context().call_on_close(
+            lambda: profiler.dump_stats(profile)
+        )
+        profiler.enable()
+        click.get_current_context().call_on_close(profiler.disable)
+
+    with stage(stats, 'load'):
+        if macros:
+            macros_dict, macros_file = load_macros(macros)
+
+        asm_tree, isa = _isa_option(asm_dict, cache_dir)
+        assembler = Assembler(
+            asm_tree, macros_dict if macros else None, stats, isa,
+            optimize_code
+        )
+
+    if len(filenames) > 1:
+        with stage(stats, 'read'):
+            sources = [(source.name, source.read()) for source in filenames]
+        with stage(stats, 'assemble'):
+            bytecode = assemble_files(sources, asm_tree, macros, jobs)
+        assembler.write(output, bytecode, output_format)
+        size = len(bytecode)
+        lines = sum(data.count(b'\n') for _, data in sources)
+    elif stream:
+        if not filename.seekable():
+            raise click.BadParameter(
+                '--stream needs a seekable input file', param_hint='FILENAME'
+            )
+        with stage(stats, 'assemble'):
+            size = stream_asemble(
+                filename, output, asm_tree, macros_dict if macros else None,
+                WRITERS[output_format]
+            )
+        lines = None
+    elif not filename.seekable() and not (cache or bulk or optimize_code or
+                                          jobs != 1):
+        with stage(stats, 'assemble'):
+            size = pipe_asemble(
+                filename, output, asm_tree, macros_dict if macros else None,
+                WRITERS[output_format]
+            )
+        lines = None
+    elif cache:
+        macros_source = b''
+        if macros:
+            with open(macros_file, 'rb') as macro_file:
+                macros_source = macro_file.read()
+        with stage(stats, 'read'):
+            data = filename.read()
+        with stage(stats, 'assemble'):
+            data, size = cached_asemble(
+                data, asm_tree, WRITERS[output_format],
+                (os.path.abspath(filename.name), digest(asm_tree),
+                 digest(macros_source), output_format, __version__),
+                cache_dir or default_cache_dir(),
+                macros_dict if macros else None
+            )
+        with stage(stats, 'write'):
+            output.write(data)
+        lines = None
+    else:
+        with read_source(filename) as data:
+            with stage(stats, 'read'):
+                lines = count_lines(data) if stats else None
+            if bulk:
+                bytecode = assembler.assemble_bulk(data)
+            elif jobs != 1:
+                bytecode = assembler.assemble_parallel(data, jobs)
+            else:
+                bytecode = assembler.assemble(data)
+        assembler.write(output, bytecode, output_format)
+        size = len(bytecode)
+        if optimize_code:
+            click.echo('Optimized: {} words and {} cycles per pass saved ({})'
+                       .format(
+                           assembler.saved['words'], assembler.saved['cycles'],
+                           ', '.join('{} {}'.format(value, key) for key, value
+                                     in list(assembler.saved.items())[:4])
+                       ), err=True)
+
+    if rom_wrapper:
+        write_rom_wrapper(
+            rom_wrapper, os.path.basename(output.name), size,
+            asm_tree['_config'],
+            '$readmemh' if output_format == 'memh' else '$readmemb'
+        )
+
+    if stats:
+        if lines is not None:
+            stats.count('lines', lines)
+        if 'instructions' not in stats.counters:
+            stats.count('instructions', size)
+        if show_stats:
+            click.echo(stats.format(), err=True)
+        if profile and profile.endswith('.json'):
+            import json
+            with open(profile, 'w') as trace:
+                json.dump(stats.trace(), trace, indent=1)
+
+
+_BATCH_ASSEMBLER = None
+
+
+def describe_error(err):
+    ''' Joins the messages of an exception and the ones it was raised from '''
+    messages = []
+    while err is not None:
+        messages.append(str(err))
+        err = err.__cause__
+    return ': '.join(messages)
+
+
+def _batch_assembler(asm_def, macros):
+    return Assembler(asm_def, load_macros(macros)[0] if macros else None)
+
+
+def _init_batch(asm_def, macros):
+    global _BATCH_ASSEMBLER
+    _BATCH_ASSEMBLER = _batch_assembler(asm_def, macros)
+
+
+def batch_job(job, assembler=None):
+    ''' Assembles one ``(input, output, format)`` batch entry
+
+    Returns ``(input, output, size, error)``, where ``error`` is ``None``
+    on success. Runs with ``assembler``, or in a pool worker with the one
+    set up by ``_init_batch``.
+    '''
+    source, target, output_format = job
+    if assembler is None:
+        assembler = _BATCH_ASSEMBLER
+    try:
+        with open(source, 'rb') as source_file, \
+                read_source(source_file) as data:
+            words = assembler.assemble(data)
+        with open(target, 'wb') as target_file:
+            assembler.write(target_file, words, output_format)
+    except Exception as err:
+        return source, target, None, describe_error(err)
+    return source, target, len(words), None
+
+
+def run_batch(jobs, asm_def=None, macros=None, processes=0):
+    ''' Assembles ``(input, output, format)`` entries, yielding their status
+
+    Entries are spread over a pool of ``processes`` workers (all cores when
+    0), each one keeping a single ``Assembler`` for all its programs.
+    Results are yielded in the order of ``jobs``, see ``batch_job``.
+    '''
+    if processes == 1 or len(jobs) < 2:
+        assembler = _batch_assembler(asm_def, macros)
+        for job in jobs:
+            yield batch_job(job, assembler)
+        return
+
+    from concurrent.futures import ProcessPoolExecutor
+    processes = processes or os.cpu_count() or 1
+    with ProcessPoolExecutor(
+            processes, initializer=_init_batch, initargs=(asm_def, macros)
+    ) as pool:
+        chunksize = max(1, len(jobs) // (processes * 4))
+        for status in pool.map(batch_job, jobs, chunksize=chunksize):
+            yield status
+
+
+def read_manifest(manifest):
+    ''' Reads ``input output`` pairs, one per line, from a text file
+
+    Blank lines and lines starting with ``#`` are ignored. Relative paths
+    are taken from the directory of the manifest.
+    '''
+    import click
+    base = os.path.dirname(os.path.abspath(manifest.name))
+    pairs = []
+    for number, line in enumerate(manifest, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        fields = line.split()
+        if len(fields) != 2:
+            raise click.BadParameter(
+                'line {}: expected "input output", got {}'.format(
+                    number, line
+                ), param_hint='MANIFEST'
+            )
+        pairs.append(tuple(os.path.join(base, path) for path in fields))
+    return pairs
+
+
+def _batch(manifest, patterns, out_dir, asm_dict, macros, output_format,
+           jobs):
+    ''' Assembles many MiniAlu programs in one invocation
+
+    MANIFEST: Text file with an "input output" pair per line
+
+    Inputs matched by --glob are written next to them, or to --out-dir,
+    with the extension of the output format.
+'''
+    import click
+    import glob
+
+    pairs = read_manifest(manifest) if manifest else []
+    for pattern in patterns:
+        for path in sorted(glob.glob(pattern, recursive=True)):
+            stem = os.path.splitext(path)[0]
+            if out_dir:
+                stem = os.path.join(out_dir, os.path.basename(stem))
+            pairs.append((path, stem + EXTENSIONS[output_format]))
+    if not pairs:
+        raise click.UsageError('No input files, give a MANIFEST or --glob')
+    if out_dir:
+        os.makedirs(out_dir, exist_ok=True)
+
+    asm_tree = _isa_option(asm_dict)[0]
+
+    failed = 0
+    for source, target, size, error in run_batch(
+            [(source, target, output_format) for source, target in pairs],
+            asm_tree, macros, jobs):
+        if error is None:
+            click.echo('ok    {} -> {} ({} words)'.format(
+                source, target, size
+            ))
+        else:
+            failed += 1
+            click.echo('FAIL  {}: {}'.format(source, error), err=True)
+    click.echo('{} assembled, {} failed'.format(len(pairs) - failed, failed))
+    if failed:
+        raise SystemExit(1)
+
+
+def _simulate(filename, asm_dict, macros, max_cycles):
+    ''' Assembles and runs a MiniAlu program on the instruction set simulator
+
+    FILENAME: Input asm file
+
+    Prints the cycle count, the values written to the LEDs and the non zero
+    registers.
+'''
+    import click
+    asm_tree, isa = _isa_option(asm_dict)
+    assembler = Assembler(
+        asm_tree, load_macros(macros)[0] if macros else None, isa=isa
+    )
+    sim = Simulator(
+        assembler.assemble(filename.read().decode('utf-8')), asm_tree
+    )
+    sim.run(max_cycles)
+    click.echo('{} after {} cycles at address {}'.format(
+        'halted' if sim.halted else 'stopped', sim.cycles, sim.pc
+    ))
+    click.echo('LED: {}'.format(' '.join(str(value) for value in sim.leds)))
+    for index, value in enumerate(sim.registers):
+        if value:
+            click.echo('R{}: {}'.format(index, value))
+
+
+class Server(object):
+    ''' Long lived assembler answering JSON requests, one per line
+
+    Instruction sets and macro modules are loaded once and kept, with their
+    ``Assembler``, until their files change on disk. A request looks like::
+
+        {"id": 1, "source": "STO R1, 1\\nLED R1", "format": "rom"}
+
+    ``filename`` may replace ``source`` to read the program from a file,
+    and ``asm_dict`` and ``macros`` paths override the server defaults.
+    ``format`` is ``words`` (default) or one of ``WRITERS``. The response
+    echoes ``id`` and carries ``words`` or ``output`` (base64 encoded for
+    ``bin``), ``size`` and the ``elapsed`` seconds, or an ``error``.
+    '''
+
+    def __init__(self, asm_dict=None, macros=None):
+        import threading
+        self.asm_dict = asm_dict
+        self.macros = macros
+        self.assemblers = {}
+        self.lock = threading.Lock()
+
+    def assembler(self, asm_dict=None, macros=None):
+        ''' Returns the assembler for an instruction set and macro file '''
+        paths = tuple(
+            os.path.abspath(path) if path else None
+            for path in (asm_dict or self.asm_dict, macros or self.macros)
+        )
+        key = tuple(
+            (path, os.stat(path).st_mtime_ns) if path else None
+            for path in paths
+        )
+        with self.lock:
+            assembler = self.assemblers.get(key)
+            if assembler is None:
+                asm_def, isa = DEFAULT_INS, None
+                if paths[0]:
+                    with open(paths[0], 'rb') as asm_file:
+                        asm_def, isa = load_isa(asm_file.read())
+                assembler = Assembler(
+                    asm_def, load_macros(paths[1], True)[0] if paths[1]
+                    else None, isa=isa
+                )
+                for stale in [old for old in self.assemblers
+                              if tuple(entry and entry[0] for entry in old)
+                              == paths]:
+                    del self.assemblers[stale]
+                self.assemblers[key] = assembler
+        return assembler
+
+    def handle(self, request):
+        ''' Assembles one request, returning the response object '''
+        start = time.perf_counter()
+        response = {'id': request.get('id')}
+        try:
+            assembler = self.assembler(
+                request.get('asm_dict'), request.get('macros')
+            )
+            if 'source' in request:
+                text = request['source']
+            else:
+                with open(request['filename'], 'rb') as source_file:
+                    text = source_file.read().decode('utf-8')
+            words = assembler.assemble(text)
+            output_format = request.get('format', 'words')
+            if output_format == 'words':
+                response['words'] = list(words)
+            else:
+                output = io.BytesIO()
+                assembler.write(output, words, output_format)
+                output = output.getvalue()
+                if output_format == 'bin':
+                    import base64
+                    output = base64.b64encode(output)
+                response['output'] = output.decode('ascii')
+            response['size'] = len(words)
+        except Exception as err:
+            response['error'] = describe_error(err)
+        response['elapsed'] = time.perf_counter() - start
+        return response
+
+    def respond(self, line):
+        ''' Answers a JSON request line with a JSON response line '''
+        import json
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError('a request must be a JSON object')
+        except ValueError as err:
+            response = {'id': None, 'error': 'Invalid request: {}'.format(err)}
+        else:
+            response = self.handle(request)
+        return json.dumps(response) + '\n'
+
+    def serve_lines(self, requests, responses):
+        ''' Answers requests from a text file until it ends '''
+        for line in requests:
+            if line.strip():
+                responses.write(self.respond(line))
+                responses.flush()
+
+    def serve_socket(self, path):
+        ''' Answers requests on a Unix domain socket, a thread per client '''
+        import stat
+        import socketserver
+
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    if line.strip():
+                        self.wfile.write(
+                            server.respond(line.decode('utf-8')).encode()
+                        )
+
+        if os.path.lexists(path):
+            if not stat.S_ISSOCK(os.lstat(path).st_mode):
+                raise Exception(
+                    'Refusing to replace {}, it is not a socket'.format(path)
+                )
+            os.remove(path)
+        with socketserver.ThreadingUnixStreamServer(path, Handler) as unix:
+            unix.daemon_threads = True
+            try:
+                unix.serve_forever()
+            finally:
+                os.remove(path)
+
+
+def _serve(socket, asm_dict, macros):
+    ''' Keeps assemblers loaded and answers JSON requests, one per line
+
+    Requests are read from stdin and answered on stdout, or from clients of
+    the Unix domain socket given with --socket. See the Server class for
+    the protocol.
+'''
+    server = Server(asm_dict, macros)
+    if socket:
+        import signal
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        server.serve_socket(socket)
+    else:
+        server.serve_lines(sys.stdin, sys.stdout)
+
+
+def _disasm(filename, output, asm_dict, input_format):
+    ''' Turns a ROM module or memory image back into MiniAlu assembly
+
+    FILENAME: ROM module or image, its format is taken from the extension
+    unless --format is given
+
+    OUTPUT: Output asm file, standard output by default
+'''
+    import click
+    if not input_format:
+        extension = os.path.splitext(filename.name)[1].lower()
+        formats = {value: key for key, value in EXTENSIONS.items()}
+        formats.update({'.memh': 'memh', '.memb': 'memb'})
+        if extension not in formats:
+            raise click.BadParameter(
+                'unknown extension {!r}, give --format'.format(extension),
+                param_hint='FILENAME'
+            )
+        input_format = formats[extension]
+    asm_tree = _isa_option(asm_dict)[0]
+    words = READERS[input_format](filename.read(), asm_tree['_config'])
+    write_lines(output, (
+        line + '\n' for line in disassemble(words, asm_tree)
+    ))
+
+
+def _commands():
+    ''' Builds the click commands, only once they are needed
+
+    Importing click takes longer than assembling a small program, so the
+    module loads without it and ``main``, ``batch``, ``simulate``, ``serve``
+    and ``disasm`` are created here on first access.
+    '''
+    import click
+
+    @click.command(help=_main.__doc__)
+    @click.argument(
+        'filenames', nargs=-1, required=True, type=click.File('rb'))
+    @click.argument('output', type=click.File('wb'))
+    @click.option(
+        '--asm-dict', default=None, type=click.File('rb'),
+        help='File containing a python dictionary with the asm instructions '
+             'set')
+    @click.option(
+        '--macros', default=None,
+        help='File containing a python module with macro definitions')
+    @click.option(
+        '--stream', is_flag=True,
+        help='Assemble in two passes over FILENAME, keeping memory use flat')
+    @click.option(
+        '--format', 'output_format', default='rom',
+        type=click.Choice(WRITERS),
+        help='Output format: verilog ROM module (default), $readmemh or '
+             '$readmemb image, raw binary or Intel HEX')
+    @click.option(
+        '--rom-wrapper', default=None, type=click.File('wb'),
+        help='With --format memh or memb, also write a ROM module that '
+             'loads OUTPUT')
+    @click.option(
+        '--cache', is_flag=True,
+        help='Reuse the results of the previous build of FILENAME')
+    @click.option(
+        '--cache-dir', default=None, type=click.Path(file_okay=False),
+        help='Cache location for builds and instruction sets, defaults '
+             'to $MAASM_CACHE_DIR or ~/.cache/maasm')
+    @click.option(
+        '--jobs', '-j', default=1, type=click.IntRange(0),
+        help='Processes used to assemble, 0 for all cores. Several '
+             'FILENAMES are assembled apart, a single one in chunks')
+    @click.option(
+        '--bulk', is_flag=True,
+        help='Encode with NumPy array operations, for very large programs')
+    @click.option(
+        '--stats', 'show_stats', is_flag=True,
+        help='Print stage timings, counters and peak memory to stderr')
+    @click.option(
+        '--profile', default=None, type=click.Path(dir_okay=False),
+        help='Write stage timings as a Chrome trace if the name ends in '
+             '.json, else a cProfile dump')
+    @click.option(
+        '-O', '--optimize', 'optimize_code', is_flag=True,
+        help='Thread jumps and remove dead code and redundant stores, '
+             'reporting the words and cycles saved')
+    def main(**options):
+        _main(**options)
+
+    @click.command(help=_batch.__doc__)
+    @click.argument('manifest', required=False, type=click.File('r'))
+    @click.option(
+        '--glob', 'patterns', multiple=True,
+        help='Assemble the files matching this pattern (may be repeated)')
+    @click.option(
+        '--out-dir', default=None, type=click.Path(file_okay=False),
+        help='Output directory for --glob inputs, defaults to their own')
+    @click.option(
+        '--asm-dict', default=None, type=click.File('rb'),
+        help='File containing a python dictionary with the asm instructions '
+             'set')
+    @click.option(
+        '--macros', default=None,
+        help='File containing a python module with macro definitions')
+    @click.option(
+        '--format', 'output_format', default='rom',
+        type=click.Choice(WRITERS),
+        help='Output format, see maasm --help')
+    @click.option(
+        '--jobs', '-j', default=0, type=click.IntRange(0),
+        help='Worker processes, 0 (default) for all cores')
+    def batch(**options):
+        _batch(**options)
+
+    @click.command(help=_simulate.__doc__)
+    @click.argument('filename', type=click.File('rb'))
+    @click.option(
+        '--asm-dict', default=None, type=click.File('rb'),
+        help='File containing a python dictionary with the asm instructions '
+             'set')
+    @click.option(
+        '--macros', default=None,
+        help='File containing a python module with macro definitions')
+    @click.option(
+        '--max-cycles', default=10 ** 7, type=click.IntRange(1),
+        help='Stop after this many cycles (default 10000000)')
+    def simulate(**options):
+        _simulate(**options)
+
+    @click.command(help=_serve.__doc__)
+    @click.option(
+        '--socket', default=None, type=click.Path(dir_okay=False),
+        help='Listen on this Unix domain socket instead of stdin')
+    @click.option(
+        '--asm-dict', default=None, type=click.Path(exists=True),
+        help='Default instruction set, see maasm --help')
+    @click.option(
+        '--macros', default=None, type=click.Path(exists=True),
+        help='Default macro module, see maasm --help')
+    def serve(**options):
+        _serve(**options)
+
+    @click.command(help=_disasm.__doc__)
+    @click.argument('filename', type=click.File('rb'))
+    @click.argument('output', default='-', type=click.File('wb'))
+    @click.option(
+        '--asm-dict', default=None, type=click.File('rb'),
+        help='File containing a python dictionary with the asm instructions '
+             'set')
+    @click.option(
+        '--format', 'input_format', default=None, type=click.Choice(READERS),
+        help='Input format, see maasm --help')
+    def disasm(**options):
+        _disasm(**options)
+
+    return {
+        'main': main, 'batch': batch, 'simulate': simulate, 'serve': serve,
+        'disasm': disasm,
+    }
+
+
+def __getattr__(name):
+    if name in ('main', 'batch', 'simulate', 'serve', 'disasm'):
+        commands = _commands()
+        globals().update(commands)
+        return commands[name]
+    if name == 'ROM_TEMPLATE':
+        from jinja2 import Template
+        template = globals()['ROM_TEMPLATE'] = Template(ROM_SOURCE)
+        return template
+    raise AttributeError(
+        'module {!r} has no attribute {!r}'.format(__name__, name)
+    )
+
+
+def run(argv=None):
+    ''' Entry point of the maasm command
+
+    ``maasm [--asm-dict FILE] [--format FORMAT] FILENAME OUTPUT`` is
+    assembled right away with the native writers, without loading click;
+    any other command line, or files that can not be opened, go through
+    ``main``, which reports the problem.
+    '''
+    args = sys.argv[1:] if argv is None else list(argv)
+    options = {'--asm-dict': None, '--format': 'rom'}
+    paths = []
+    while args:
+        arg = args.pop(0)
+        name, equals, value = arg.partition('=')
+        if name in options and (equals or args):
+            options[name] = value if equals else args.pop(0)
+        elif arg.startswith('-') and arg != '-':
+            break
+        else:
+            paths.append(arg)
+    else:
+        if len(paths) == 2 and options['--format'] in WRITERS and \
+                '-' not in paths:
+            source, target = paths
+            asm_tree, isa = DEFAULT_INS, None
+            try:
+                if options['--asm-dict']:
+                    with open(options['--asm-dict'], 'rb') as asm_dict:
+                        asm_tree, isa = load_isa(
+                            asm_dict.read(), default_cache_dir()
+                        )
+                source_file = open(source, 'rb')
+            except Exception:
+                pass  # main reports the problem with --asm-dict or FILENAME
+            else:
+                assembler = Assembler(asm_tree, isa=isa)
+                with source_file, read_source(source_file) as data:
+                    words = assembler.assemble(data)
+                try:
+                    output = open(target, 'wb')
+                except OSError:
+                    pass  # and with OUTPUT
+                else:
+                    with output:
+                        assembler.write(output, words, options['--format'])
+                    return
+    _commands()['main'](sys.argv[1:] if argv is None else argv)
 
 
 if __name__ == '__main__':
-    main()
+    run()
@@ -63,10 +63,15 @@ setup(
     py_modules=['maasm'],
     entry_points ='''
     [console_scripts]
-    maasm = maasm:main
+    maasm = maasm:run
+    maasm-batch = maasm:batch
+    maasm-sim = maasm:simulate
+    maasm-serve = maasm:serve
+    maasm-dis = maasm:disasm
     ''',
 
     # Dependencies
+    python_requires='>=3.7',
     install_requires=find_requirements('requirements.txt'),
 
     # Metadata
@@ -80,6 +85,12 @@ setup(
     keywords='maasm',
 
     classifiers=[
-        'Programming Language :: Python :: 3.4',
+        'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3 :: Only',
+        'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
     ]
 )
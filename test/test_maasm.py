@@ -24,9 +24,23 @@ See http://pythontesting.net/framework/pytest/pytest-introduction/#fixtures
 from __future__ import unicode_literals, absolute_import
 from __future__ import print_function, division
 
+import io
+import os
+import time
+
 import pytest  # noqa
 
-from maasm import __version__
+from maasm import __version__, DEFAULT_INS, ROM_TEMPLATE, Token
+from maasm import compile_isa, encode, tokenize, assemble_tokens, str2int
+from maasm import asemble, resolve_symbols, stream_asemble, write_rom
+from maasm import write_memh, write_memb, write_bin, write_ihex
+from maasm import cached_asemble, assemble_files, Assembler, run_batch
+from maasm import batch_job
+from maasm import compile_decoder, decode, Simulator, expand_macro, token_text
+from maasm import Stats, run, Server, parse_isa, load_isa, parallel_encode
+from maasm import WRITERS, READERS, disassemble, optimize, Program
+from maasm import encode_program, scan_source, map_source, read_source
+from maasm import pipe_asemble, pipe_encode, pipe_stage, load_cache
 
 
 def setup_module(module):
@@ -48,3 +62,934 @@ def test_semantic_version():
     assert mayor >= 0
     assert minor >= 0
     assert rev >= 0
+
+
+def test_compile_isa():
+    """
+    Check that mnemonics are compiled into shift/mask encoder tables.
+    """
+    isa = compile_isa(DEFAULT_INS)
+
+    opword, num, fields = isa['STO']
+    assert opword == 4 << 24
+    assert num == 2
+    assert fields == [('arg', 16, 0xff), ('value', 0, 0xffff)]
+    assert isa['_config']['bin_format'] == '028b'
+
+
+def test_encode():
+    """
+    Check that instructions are packed into a single word.
+    """
+    isa = compile_isa(DEFAULT_INS)
+
+    assert encode(isa, 'STO', ['R1', '5']) == 0x4010005
+    assert encode(isa, 'ADD', ['R3', 'R1', 'R2']) == 0x5030102
+    assert encode(isa, 'NOP', []) == 0
+
+    with pytest.raises(Exception):
+        encode(isa, 'LED', ['R256'])
+
+
+def test_tokenize():
+    """
+    Check that labels, constants and instructions are tokenized.
+    """
+    source = [
+        '# comment',
+        'ONE = 1',
+        '',
+        'loop: ADD R1, R1, R2  # increment',
+        '    STO,R1,ONE',
+    ]
+    tokens = list(tokenize(source))
+
+    assert tokens == [
+        Token('const', 'ONE', ('1',), 2, 1),
+        Token('label', 'loop', (), 4, 1),
+        Token('ins', 'ADD', ('R1', 'R1', 'R2'), 4, 7),
+        Token('ins', 'STO', ('R1', 'ONE'), 5, 5),
+    ]
+
+    with pytest.raises(Exception):
+        list(tokenize(['= 5']))
+
+
+SOURCE = '''\
+# sample program
+ONE = 1
+    STO R1, 0
+    STO R2, ONE
+loop:
+    ADD R1, R1, R2  # increment
+    LED R1
+    BLE loop, R1, R3
+    JMP end
+    NOP
+end:
+    JMP loop
+'''
+
+
+def test_stream_asemble():
+    """
+    Check that streaming assembly matches the in-memory ROM rendering.
+    """
+    tokens = list(tokenize(SOURCE.splitlines()))
+    tags = {}
+    constants = {}
+    resolve_symbols(tokens, tags, constants)
+    bytecode, asm_ins = asemble(tokens, DEFAULT_INS, tags, constants)
+    expected = ROM_TEMPLATE.render(
+        asm=["28'b{:028b}".format(word) for word in bytecode],
+        addr_len=15, ins_len=27, asm_ins=asm_ins
+    ).encode('utf-8')
+
+    output = io.BytesIO()
+    stream_asemble(io.BytesIO(SOURCE.encode('utf-8')), output, DEFAULT_INS)
+
+    assert output.getvalue() == expected
+
+
+@pytest.mark.parametrize('output_format', sorted(WRITERS))
+def test_pipe_asemble(output_format):
+    """
+    Check that the pipelined assembler matches the in-memory one, holding
+    back only the words waiting for a forward reference.
+    """
+    expected = io.BytesIO()
+    assembler = Assembler()
+    assembler.write(expected, assembler.assemble(SOURCE), output_format)
+
+    output = io.BytesIO()
+    size = pipe_asemble(
+        io.BytesIO(SOURCE.encode('utf-8')), output, DEFAULT_INS, None,
+        WRITERS[output_format], batch_size=2, depth=1
+    )
+    assert size == 8
+    assert output.getvalue() == expected.getvalue()
+
+    isa = compile_isa(DEFAULT_INS)
+    batches = [list(tokenize(lines)) for lines in (
+        ['NOP', 'JMP later', 'NOP'], ['X = 1', 'STO R1, X', 'later:'],
+        ['X = 2', 'STO R1, X'],
+    )]
+    encoded = list(pipe_encode(batches, isa, {}, {}))
+    assert [len(words) for words in encoded] == [1, 3, 1]
+    assert sum(encoded, []) == assemble_tokens(
+        sum(batches, []), isa, {}, {}
+    )
+
+    with pytest.raises(Exception, match='2:1: Unable to parse args'):
+        list(pipe_encode([list(tokenize(['NOP', 'JMP nowhere']))], isa,
+                         {}, {}))
+
+
+def test_pipe_stage():
+    """
+    Check that a pipeline stage passes items and errors on, and closes its
+    source when the consumer stops early.
+    """
+    assert list(pipe_stage(iter(range(100)), 2)) == list(range(100))
+
+    def failing():
+        yield 1
+        raise ValueError('broken')
+
+    with pytest.raises(ValueError, match='broken'):
+        list(pipe_stage(failing()))
+
+    closed = []
+
+    def endless():
+        try:
+            while True:
+                yield 0
+        finally:
+            closed.append(True)
+
+    stage = pipe_stage(endless(), 1)
+    assert next(stage) == 0
+    stage.close()
+    for _ in range(50):
+        if closed:
+            break
+        time.sleep(0.01)
+    assert closed
+
+
+@pytest.mark.parametrize('words', [[], [0x4010005], list(range(10))])
+def test_write_rom(words):
+    """
+    Check that the native writer is byte-identical to ROM_TEMPLATE.
+    """
+    expected = ROM_TEMPLATE.render(
+        asm=["28'b{:028b}".format(word) for word in words],
+        addr_len=15, ins_len=27, asm_ins=[]
+    ).encode('utf-8')
+
+    output = io.BytesIO()
+    write_rom(output, words, DEFAULT_INS['_config'], chunk_size=3)
+
+    assert output.getvalue() == expected
+
+
+def test_image_writers():
+    """
+    Check the $readmemh, $readmemb and raw binary images.
+    """
+    config = DEFAULT_INS['_config']
+    words = [0x4010005, 0x5030102]
+
+    output = io.BytesIO()
+    write_memh(output, words, config)
+    assert output.getvalue() == b'4010005\n5030102\n'
+
+    output = io.BytesIO()
+    write_memb(output, words, config)
+    assert output.getvalue().splitlines()[0] == (
+        b'0100000000010000000000000101'
+    )
+
+    output = io.BytesIO()
+    write_bin(output, words, config)
+    assert output.getvalue() == bytes.fromhex('04010005 05030102')
+
+
+def test_write_ihex():
+    """
+    Check Intel HEX checksums, record split and extended addressing.
+    """
+    words = list(range(0x4001))
+    output = io.BytesIO()
+    write_ihex(output, words, DEFAULT_INS['_config'], chunk_size=5)
+    records = output.getvalue().decode('ascii').splitlines()
+
+    data = b''
+    for record in records:
+        raw = bytes.fromhex(record[1:])
+        assert sum(raw) & 0xff == 0
+        if raw[3] == 0:
+            data += raw[4:-1]
+    assert data == b''.join(word.to_bytes(4, 'big') for word in words)
+    assert records[4096] == ':020000040001F9'
+    assert records[-1] == ':00000001FF'
+
+
+def test_cached_asemble(tmp_path, monkeypatch):
+    """
+    Check that the build cache returns the same output as a fresh build.
+    """
+    def build(source):
+        output = io.BytesIO()
+        stream_asemble(io.BytesIO(source), output, DEFAULT_INS)
+        return output.getvalue()
+
+    key = ('prog.asm', 'isa', 'macros', 'rom')
+    data = SOURCE.encode('utf-8')
+    output, size = cached_asemble(
+        data, DEFAULT_INS, write_rom, key, str(tmp_path)
+    )
+    assert output == build(data)
+    assert size == 8
+
+    changed = data.replace(b'LED R1', b'LED R2')
+    output, size = cached_asemble(
+        changed, DEFAULT_INS, write_rom, key, str(tmp_path)
+    )
+    assert output == build(changed)
+
+    entry, = tmp_path.iterdir()
+    memo = load_cache(str(entry))['memo']
+    assert ('LED', ('R2',)) in memo
+    assert ('LED', ('R1',)) not in memo
+
+    monkeypatch.setattr('maasm.tokenize', None)
+    assert cached_asemble(
+        changed, DEFAULT_INS, write_rom, key, str(tmp_path)
+    ) == (output, size)
+
+
+@pytest.mark.parametrize('source,expected', [
+    ('X = 1\nSTO R1, X\nX = 2\nSTO R1, X\n', [0x4010001, 0x4010002]),
+    ('JMP L\nL:\nNOP\nL:\nNOP\nJMP L\n',
+     [0x6010000, 0, 0, 0x6020000]),
+    ('STO R1, C\nC = 3\nSTO R2, C\nC = 4\nSTO R3, C\n',
+     [0x4010003, 0x4020003, 0x4030004]),
+])
+def test_redefined_symbols(tmp_path, source, expected):
+    """
+    Check that every path gives a reference the latest definition before
+    it, or the first one when there is none.
+    """
+    assert Assembler().assemble(source).tolist() == expected
+    assert parallel_encode(
+        tokenize(source.splitlines()), compile_isa(DEFAULT_INS), {}, {}, 1, 1
+    ).tolist() == expected
+
+    def memh(words):
+        output = io.BytesIO()
+        write_memh(output, words, DEFAULT_INS['_config'])
+        return output.getvalue()
+
+    data = source.encode('utf-8')
+    for _ in range(2):
+        assert cached_asemble(
+            data, DEFAULT_INS, write_memh, ('prog.asm',), str(tmp_path)
+        ) == (memh(expected), len(expected))
+
+    output = io.BytesIO()
+    stream_asemble(io.BytesIO(data), output, DEFAULT_INS, None, write_memh)
+    assert output.getvalue() == memh(expected)
+
+    output = io.BytesIO()
+    pipe_asemble(io.BytesIO(data), output, DEFAULT_INS, None, write_memh,
+                 batch_size=1)
+    assert output.getvalue() == memh(expected)
+
+    def defined(lines):
+        return {token.name for token in tokenize(lines)
+                if token.kind != 'ins'}
+
+    # each file has its own symbols, so it matches the concatenation when
+    # no symbol is defined in both
+    lines = source.splitlines(True)
+    for split in range(len(lines) + 1):
+        if defined(lines[:split]) & defined(lines[split:]):
+            continue
+        assert assemble_files(
+            [('a', ''.join(lines[:split]).encode('utf-8')),
+             ('b', ''.join(lines[split:]).encode('utf-8'))],
+            DEFAULT_INS
+        ) == expected
+
+
+def test_assemble_files():
+    """
+    Check that linking files matches assembling their concatenation.
+    """
+    lines = SOURCE.splitlines(True)
+    first = ''.join(lines[:5]).encode('utf-8')
+    second = ''.join(lines[5:]).encode('utf-8')
+
+    assembler = Assembler()
+    bytecode = assembler.assemble(SOURCE).tolist()
+    assert assembler.tags == {'loop': 2, 'end': 7}
+
+    assert assemble_files(
+        [('a.asm', first), ('b.asm', second)], DEFAULT_INS
+    ) == bytecode
+
+    with pytest.raises(Exception, match='b.asm:2: Undefined Symbol: nowhere'):
+        assemble_files(
+            [('a.asm', first), ('b.asm', b'\nJMP nowhere\n')], DEFAULT_INS
+        )
+    with pytest.raises(Exception, match='Symbol x is defined in a, b'):
+        assemble_files(
+            [('a', b'x:\n'), ('b', b'x:\n'), ('c', b'JMP x\n')], DEFAULT_INS
+        )
+    for value in (b'-1', b'65536'):
+        with pytest.raises(Exception, match='b:1: Value X does not fit'):
+            assemble_files(
+                [('a', b'X = ' + value + b'\n'), ('b', b'STO R1, X\n')],
+                DEFAULT_INS
+            )
+
+
+def test_assembler_reentrant():
+    """
+    Check that symbols do not leak between programs.
+    """
+    assembler = Assembler()
+    assert assembler.assemble('x:\nJMP x\n').tolist() == [0x6000000]
+    with pytest.raises(Exception, match='Unable to parse'):
+        assembler.assemble('JMP x\n')
+    assert assembler.assemble(['NOP', 'x: JMP x']).tolist() == [0, 0x6010000]
+    assert assembler.tags == {'x': 1}
+
+
+@pytest.mark.parametrize('processes', [1, 2])
+def test_run_batch(tmp_path, processes):
+    """
+    Check that batch entries are assembled and failures reported.
+    """
+    import maasm
+
+    jobs = []
+    for name, source in (('good', SOURCE), ('bad', 'JMP nowhere\n')):
+        path = tmp_path / '{}.asm'.format(name)
+        path.write_text(source)
+        jobs.append((str(path), str(tmp_path / name) + '.hex', 'memh'))
+
+    good, bad = run_batch(jobs, processes=processes)
+
+    assert good == (jobs[0][0], jobs[0][1], 8, None)
+    assert (tmp_path / 'good.hex').read_text().startswith('4010000\n')
+    assert bad[2] is None
+    assert bad[3].endswith('Undefined Symbol: nowhere')
+    assert batch_job(jobs[0], Assembler()) == good
+    assert maasm._BATCH_ASSEMBLER is None
+
+
+def test_assemble_tokens_fixups():
+    """
+    Check that forward references are patched after a single pass.
+    """
+    isa = compile_isa(DEFAULT_INS)
+    tags = {}
+    constants = {}
+    words = assemble_tokens(
+        tokenize(['JMP end', 'STO R1, LATER', 'end:', 'LATER = 7', 'NOP']),
+        isa, tags, constants
+    )
+
+    assert words == [0x6020000, 0x4010007, 0]
+    assert tags == {'end': 2}
+    assert constants == {'LATER': 7}
+
+    with pytest.raises(Exception, match='2:1: Unable to parse'):
+        assemble_tokens(
+            tokenize(['NOP', 'JMP far', 'far = 256']), isa, {}, {}
+        )
+
+
+def test_decode():
+    """
+    Check that the decode table inverts the encoder.
+    """
+    isa = compile_isa(DEFAULT_INS)
+    decoder = compile_decoder(DEFAULT_INS)
+
+    assert decode(decoder, encode(isa, 'BLE', ['7', 'R1', 'R2'])) == (
+        'BLE', [7, 1, 2]
+    )
+    assert decode(decoder, 0) == ('NOP', [])
+    assert decode(decoder, 0xf000000) is None
+
+
+def test_simulator():
+    """
+    Check a counting loop on the instruction set simulator.
+    """
+    words = Assembler().assemble('''
+        N = 10
+            STO R1, 0
+            STO R2, 1
+            STO R3, N
+        loop:
+            ADD R1, R1, R2
+            LED R1
+            BLE loop, R1, R3
+        end: JMP end
+    ''')
+    sim = Simulator(words)
+
+    assert sim.run(max_cycles=5) == 5
+    assert not sim.halted
+    sim.run()
+    assert sim.halted
+    assert sim.pc == 6
+    assert sim.leds == list(range(1, 12))
+    assert list(sim.registers[1:4]) == [11, 1, 10]
+    assert sim.cycles == 3 + 11 * 3 + 1
+
+    with pytest.raises(Exception, match='Unable to execute'):
+        Simulator([0xf000000]).run()
+
+
+def test_bulk_encode():
+    """
+    Check that the NumPy path matches the scalar encoder.
+    """
+    numpy = pytest.importorskip('numpy')
+    assembler = Assembler()
+    words = assembler.assemble_bulk(SOURCE)
+
+    assert words.dtype == numpy.uint32
+    assert words.tolist() == Assembler().assemble(SOURCE).tolist()
+    assert assembler.tags == {'loop': 2, 'end': 7}
+
+    output = io.BytesIO()
+    write_bin(output, words, DEFAULT_INS['_config'], chunk_size=3)
+    expected = io.BytesIO()
+    write_bin(expected, words.tolist(), DEFAULT_INS['_config'])
+    assert output.getvalue() == expected.getvalue()
+
+    with pytest.raises(Exception, match='3: Unable to parse'):
+        assembler.assemble_bulk('LED R1\nLED R2\nLED R300\n')
+    with pytest.raises(Exception, match='4: Unable to parse'):
+        assembler.assemble_bulk('NOP\nSTO R2, 3\nLED R1\nLED R300\nLED R2\n')
+    assert assembler.assemble_bulk('').tolist() == []
+
+    for source in ('X = 1\nSTO R1, X\nX = 2\nSTO R1, X\n',
+                   'a:\nJMP a\nNOP\na:\nJMP a\n'):
+        words = assembler.assemble_bulk(source)
+        assert words.dtype == numpy.uint32
+        assert words.tolist() == Assembler().assemble(source).tolist()
+
+
+@pytest.mark.parametrize('literal,value', [
+    ('42', 42),
+    ('007', 7),
+    ('0x2A', 42),
+    ('0b101010', 42),
+    ('0o52', 42),
+    ("8'h2a", 42),
+    ("'b1010_1010", 170),
+    ("16'd1_000", 1000),
+])
+def test_str2int(literal, value):
+    """
+    Check decimal, prefixed and verilog style literals.
+    """
+    assert str2int(literal) == value
+
+
+@pytest.mark.parametrize('literal', ['0x', '12ab', "4'hff", "8'q1"])
+def test_str2int_invalid(literal):
+    """
+    Check that malformed literals are rejected.
+    """
+    with pytest.raises(Exception, match='Unable to parse expression'):
+        str2int(literal)
+
+
+def test_expand_macro():
+    """
+    Check assembly and Python macros, nesting and local labels.
+    """
+    calls = []
+
+    def clear(args):
+        calls.append(args)
+        return ['STO {}, 0'.format(args[0])]
+
+    source = '''
+        .macro INC reg, step
+            ADD reg, reg, step
+        .endm
+        .macro COUNT reg, limit, step
+            CLEAR reg
+        again:
+            INC reg, step
+            BLE again, reg, limit
+        .endm
+        COUNT R1, R2, R3
+        COUNT R1, R2, R3
+    '''
+    tokens = list(expand_macro(
+        tokenize(source.splitlines()), {'CLEAR': {'func': clear}}
+    ))
+
+    assert [token_text(token) for token in tokens if token.kind == 'ins'] == [
+        'STO R1,0', 'ADD R1,R1,R3', 'BLE again.1,R1,R2',
+        'STO R1,0', 'ADD R1,R1,R3', 'BLE again.2,R1,R2',
+    ]
+    assert [token.name for token in tokens if token.kind == 'label'] == [
+        'again.1', 'again.2'
+    ]
+    assert set(token.line for token in tokens[:3]) == {11}
+    assert calls == [['R1']]
+
+    with pytest.raises(Exception, match='nests deeper than 64 levels'):
+        list(expand_macro(tokenize(['.macro LOOP', 'LOOP', '.endm', 'LOOP'])))
+    with pytest.raises(Exception, match='lacks .endm'):
+        list(expand_macro(tokenize(['.macro LOOP', 'NOP'])))
+
+
+def test_stats():
+    """
+    Check that the assembler reports stage timings and counters.
+    """
+    stats = Stats()
+    assembler = Assembler(stats=stats)
+    assembler.write(io.BytesIO(), assembler.assemble(SOURCE))
+    report = stats.report()
+
+    assert list(report['stages']) == ['tokenize', 'assemble', 'write']
+    assert report['counters'] == {
+        'tokens': 11, 'instructions': 8, 'labels': 2, 'constants': 1
+    }
+    assert report['instructions_per_second'] > 0
+    assert 'instructions/s' in stats.format()
+    assert [event['name'] for event in stats.trace()['traceEvents']] == [
+        'tokenize', 'assemble', 'write'
+    ]
+
+
+def test_run(tmp_path):
+    """
+    Check that the command line fast path matches the click command and
+    that importing maasm loads neither click nor jinja2.
+    """
+    import sys
+    import subprocess
+
+    source = tmp_path / 'prog.asm'
+    source.write_text(SOURCE)
+    run([str(source), str(tmp_path / 'fast.hex'), '--format=memh'])
+    with pytest.raises(SystemExit):
+        run(['--stats', '--format', 'memh', str(source),
+             str(tmp_path / 'click.hex')])
+    assert (tmp_path / 'fast.hex').read_bytes() == \
+        (tmp_path / 'click.hex').read_bytes()
+    for paths in ([str(tmp_path / 'missing.asm'), str(tmp_path / 'x.v')],
+                  [str(source), str(tmp_path / 'missing' / 'x.v')]):
+        with pytest.raises(SystemExit) as exit_info:
+            run(paths)
+        assert exit_info.value.code in (1, 2)
+    with pytest.raises(SystemExit) as exit_info:
+        run(['--format', 'memh', '--rom-wrapper', str(tmp_path / 'rom.v'),
+             str(source), '-'])
+    assert exit_info.value.code == 2
+    assert not (tmp_path / 'rom.v').exists()
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    piped = subprocess.run(
+        [sys.executable, os.path.join(root, 'maasm.py'), '--format', 'memh',
+         '-', '-'],
+        input=SOURCE.encode('utf-8'), stdout=subprocess.PIPE, check=True
+    )
+    assert piped.stdout == (tmp_path / 'fast.hex').read_bytes()
+
+    loaded = subprocess.check_output([
+        sys.executable, '-c',
+        'import sys, maasm; print(sorted(set(sys.modules) & '
+        '{"click", "jinja2"}))'
+    ], cwd=root)
+    assert loaded.strip() == b'[]'
+
+
+def test_server(tmp_path):
+    """
+    Check JSON-lines requests, errors and reloading a changed instruction set.
+    """
+    import json
+
+    isa = tmp_path / 'isa.py'
+    isa.write_text(repr(DEFAULT_INS))
+    server = Server(asm_dict=str(isa))
+    requests = io.StringIO('\n'.join([
+        json.dumps({'id': 1, 'source': SOURCE}),
+        json.dumps({'id': 2, 'source': 'NOP', 'format': 'memh'}),
+        '[]',
+        json.dumps({'id': 3, 'source': 'FOO R1'}),
+    ]))
+    responses = io.StringIO()
+    server.serve_lines(requests, responses)
+    first, second, invalid, failed = [
+        json.loads(line) for line in responses.getvalue().splitlines()
+    ]
+
+    assert first['id'] == 1
+    assert first['words'] == Assembler().assemble(SOURCE).tolist()
+    assert second['output'] == '0000000\n'
+    assert invalid == {
+        'id': None, 'error': 'Invalid request: a request must be a JSON object'
+    }
+    assert 'Invalid operation' in failed['error']
+    assembler = server.assembler()
+    assert server.assembler() is assembler
+
+    os.utime(str(isa), ns=(0, 0))
+    assert server.assembler() is not assembler
+    assert len(server.assemblers) == 1
+
+    with pytest.raises(Exception, match='not a socket'):
+        server.serve_socket(str(isa))
+    assert isa.read_text() == repr(DEFAULT_INS)
+
+
+def test_parse_isa():
+    """
+    Check that instruction sets are parsed as literals with defaults.
+    """
+    asm_def = parse_isa(b"{'NOP': {'op': 0, 'num': 0, 'args': ['zero']}}")
+    assert asm_def == {
+        'NOP': {'op': 0, 'num': 0, 'args': [('zero', 8)]},
+        '_config': DEFAULT_INS['_config'],
+    }
+    assert parse_isa(repr(DEFAULT_INS)) == DEFAULT_INS
+    asm_def = parse_isa("{'_config': {'reg_len': 8}}")
+    assert asm_def['_config'] == dict(DEFAULT_INS['_config'], reg_len=8)
+    assert Simulator([], asm_def).reg_mask == 0xff
+
+
+@pytest.mark.parametrize('text,message', [
+    ("__import__('os').getcwd()", 'not a python literal'),
+    ("[]", 'must be a dictionary'),
+    ("{'_config': {'ins_len': 0}}", 'ins_len must be a positive integer'),
+    ("{'_config': {'word': 8}}", 'Unknown _config keys: word'),
+    ("{'_config': {'opcode_len': 32}}", 'opcode_len is larger than ins_len'),
+    ("{'_config': {'reg_len': 65}}", 'reg_len is larger than 64'),
+    ("{'NOP': {'op': 0, 'num': 0}}", 'exactly the keys op, num and args'),
+    ("{'NOP': {'op': -1, 'num': 0, 'args': []}}", 'op must be a non negative'),
+    ("{'NOP': {'op': 0, 'num': 0, 'args': ['imm']}}", 'invalid argument'),
+    ("{'NOP': {'op': 0, 'num': 1, 'args': ['zero']}}", 'takes 1 arguments'),
+    ("{'NOP': {'op': 0, 'num': 0, 'args': [('zero', 32)]}}", 'does not fit'),
+])
+def test_parse_isa_invalid(text, message):
+    """
+    Check the schema errors of instruction set files.
+    """
+    with pytest.raises(Exception, match=message):
+        parse_isa(text)
+
+
+def test_load_isa(tmp_path, monkeypatch):
+    """
+    Check that loaded instruction sets are cached by content.
+    """
+    import maasm
+
+    data = repr(DEFAULT_INS).encode()
+    asm_def, isa = load_isa(data, str(tmp_path))
+    assert isa == compile_isa(DEFAULT_INS)
+    assert len(list(tmp_path.iterdir())) == 1
+
+    import marshal
+    import pickle
+    path, = tmp_path.iterdir()
+    assert marshal.loads(path.read_bytes()) == asm_def
+
+    monkeypatch.setattr(maasm, 'parse_isa', None)
+    assert load_isa(data, str(tmp_path)) == (asm_def, isa)
+
+    path.write_bytes(pickle.dumps(ValueError('not data')))
+    monkeypatch.undo()
+    assert load_isa(data, str(tmp_path)) == (asm_def, isa)
+
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_parallel_encode(jobs):
+    """
+    Check that chunked parallel encoding matches the serial encoder.
+    """
+    isa = compile_isa(DEFAULT_INS)
+    source = SOURCE + 'later:\nSTO R2, later\nJMP loop\n'
+    tags = {}
+    constants = {}
+    words = parallel_encode(
+        list(tokenize(source.splitlines())), isa, tags, constants, jobs, 3
+    )
+    assert words.tolist() == assemble_tokens(
+        tokenize(source.splitlines()), isa, {}, {}
+    )
+    assert tags == {'loop': 2, 'end': 7, 'later': 8}
+    assert constants == {'ONE': 1}
+
+    redefined = ['X = 1', 'STO R1, X', 'X = 2', 'STO R1, X']
+    assert parallel_encode(
+        tokenize(redefined), isa, {}, {}, jobs, 1
+    ).tolist() == assemble_tokens(tokenize(redefined), isa, {}, {})
+
+    with pytest.raises(Exception, match='3:1: Unable to parse args'):
+        parallel_encode(tokenize(['NOP', 'NOP', 'JMP nowhere']), isa, {}, {},
+                        jobs, 1)
+
+
+def test_parallel_encode_threads():
+    """
+    Check that parallel encoding from several threads at once does not mix
+    up the programs.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    isa = compile_isa(DEFAULT_INS)
+    programs = [
+        Program(isa, tokenize(
+            'STO R{}, {}'.format(n, i % 256) for i in range(2000)
+        ))
+        for n in range(8)
+    ]
+    expected = [encode_program(program, {}, {}).tolist()
+                for program in programs]
+    with ThreadPoolExecutor(4) as pool:
+        results = list(pool.map(
+            lambda program: parallel_encode(
+                program, isa, {}, {}, 1, 10
+            ).tolist(),
+            programs
+        ))
+    assert results == expected
+
+
+def test_program():
+    """
+    Check the columns of the compact IR and that encoding it matches the
+    token encoder.
+    """
+    isa = compile_isa(DEFAULT_INS)
+    program = Program(isa, tokenize(SOURCE.splitlines()))
+    assert len(program) == 8
+    assert program.ops.typecode == 'H'
+    assert program.operands.typecode == 'I'
+    assert program.lines.tolist() == [3, 4, 6, 7, 8, 9, 10, 12]
+    assert program.symbols == [
+        (0, 'const', 'ONE', 1), (2, 'label', 'loop', 2),
+        (7, 'label', 'end', 7),
+    ]
+    assert program.strings.count('R1') == 1
+    assert program.text(2, 4) == 'ADD R1,R1,R2'
+    assert [token.name for token in program.tokens()] == [
+        'ONE', 'STO', 'STO', 'loop', 'ADD', 'LED', 'BLE', 'JMP', 'NOP',
+        'end', 'JMP',
+    ]
+
+    tags = {}
+    words = encode_program(program, tags, {})
+    assert words.typecode == 'I'
+    assert words.tolist() == assemble_tokens(
+        tokenize(SOURCE.splitlines()), isa, {}, {}
+    )
+    assert tags == {'loop': 2, 'end': 7}
+    assert encode_program(
+        Program(isa, program.tokens()), {}, {}
+    ).tolist() == words.tolist()
+
+    output = io.BytesIO()
+    write_bin(output, words, DEFAULT_INS['_config'])
+    assert output.getvalue()[:8] == b'\x04\x01\x00\x00\x04\x02\x00\x01'
+
+    with pytest.raises(Exception, match="2:1: Unable to parse args"):
+        encode_program(Program(isa, tokenize(['NOP', 'JMP nowhere'])), {}, {})
+
+
+def test_scan_source(tmp_path):
+    """
+    Check that scanning bytes gives the same tokens as tokenize, and that
+    files are mapped when they can be.
+    """
+    source = SOURCE + (
+        '\xe9tiqueta: NOP\r\n.macro INC reg, step  \r\n'
+        '  ADD reg, reg, step\n.endm # done\nSTO R1 , \n'
+    )
+    assert list(scan_source(source.encode('utf-8'))) == list(
+        tokenize(source.splitlines())
+    )
+    assert list(scan_source(source.encode('utf-8'), cache_size=1)) == list(
+        tokenize(source.splitlines())
+    )
+    with pytest.raises(Exception, match='2: Syntax error on line = 3'):
+        list(scan_source(b'NOP\n= 3\n'))
+
+    path = tmp_path / 'prog.asm'
+    path.write_bytes(SOURCE.encode('utf-8'))
+    with open(str(path), 'rb') as source_file:
+        with read_source(source_file) as data:
+            assert Assembler().assemble(data).tolist() == \
+                Assembler().assemble(SOURCE).tolist()
+        assert data.closed
+    (tmp_path / 'empty.asm').write_bytes(b'')
+    with open(str(tmp_path / 'empty.asm'), 'rb') as source_file:
+        assert map_source(source_file) is None
+    assert map_source(io.BytesIO(b'NOP')) is None
+
+
+def test_scan_source_errors(tmp_path):
+    """
+    Check that an error raised halfway through scanning a mapped file is
+    the one reported, not the failure to close the map.
+    """
+    path = tmp_path / 'bad.asm'
+    path.write_bytes(b'NOP\nFOO R1\n' + b'NOP\n' * 10000)
+    with pytest.raises(Exception, match='2: Invalid operation'):
+        with open(str(path), 'rb') as source_file:
+            with read_source(source_file) as data:
+                Assembler().assemble(data)
+
+    (source, target, size, error), = run_batch(
+        [(str(path), str(tmp_path / 'bad.hex'), 'memh')], processes=1
+    )
+    assert error.endswith('2: Invalid operation on instruction FOO R1')
+
+    for source in (b'NOP\nFOO R1\nNOP\n', b'NOP\nJMP nowhere\nNOP\n'):
+        path.write_bytes(source)
+        with pytest.raises(Exception, match='2(:1)?: (Invalid|Unable)'):
+            with open(str(path), 'rb') as source_file:
+                stream_asemble(source_file, io.BytesIO(), DEFAULT_INS)
+
+
+@pytest.mark.parametrize('output_format', sorted(WRITERS))
+def test_disassemble(output_format):
+    """
+    Check that every output format reads back and disassembles to a source
+    that assembles to the same words.
+    """
+    words = Assembler().assemble(SOURCE).tolist()
+    output = io.BytesIO()
+    WRITERS[output_format](output, words, DEFAULT_INS['_config'])
+    read = READERS[output_format](output.getvalue(), DEFAULT_INS['_config'])
+    assert read == words
+
+    lines = list(disassemble(read))
+    assert lines[:4] == [
+        '    STO R1, 0', '    STO R2, 1', 'L2:', '    ADD R1, R1, R2'
+    ]
+    assert '    JMP L7' in lines
+    assert Assembler().assemble('\n'.join(lines)).tolist() == words
+
+    assert list(disassemble([0xfffffff])) == [
+        '    # unknown instruction 0xfffffff'
+    ]
+    word = 0x30501c8
+    assert list(disassemble([word])) == ['    BLE 5, R1, 200']
+    assert Assembler().assemble('BLE 5, R1, 200').tolist() == [word]
+
+
+def test_optimize():
+    """
+    Check jump threading, dead code and redundant store removal, and that
+    the optimized program computes the same.
+    """
+    source = '''
+        STO R1, 0
+        STO R1, 0
+        STO R2, ONE
+        STO R3, 5
+        STO R3, 6
+        JMP a
+        NOP
+    a:  JMP loop
+    loop:
+        ADD R1, R1, R2
+        LED R1
+        BLE loop, R1, R3
+        BLE next, R1, R3
+    next:
+        JMP end
+        NOP
+    end:
+        JMP end
+    ONE = 1
+    '''
+    tokens, saved = optimize(Assembler().tokenize(source))
+    assert [token_text(token) for token in tokens if token.kind == 'ins'] == [
+        'STO R1,0', 'STO R2,ONE', 'STO R3,6', 'ADD R1,R1,R2', 'LED R1',
+        'BLE loop,R1,R3', 'JMP end'
+    ]
+    assert saved['words'] == 8
+    assert saved['stores'] == 2
+    assert saved['cycles'] > 0
+
+    plain = Simulator(Assembler().assemble(source))
+    plain.run(1000)
+    optimized = Simulator(
+        Assembler(optimize=True).assemble(source)
+    )
+    optimized.run(1000)
+    assert optimized.halted and optimized.cycles < plain.cycles
+    assert optimized.leds == plain.leds
+    assert optimized.registers == plain.registers
+
+    unchanged = ['JMP 2', 'NOP', 'NOP']
+    assert optimize(tokenize(unchanged))[1]['words'] == 0
+
+    custom = dict(DEFAULT_INS)
+    custom['STO'] = {'op': 4, 'num': 2, 'args': [('value', 16), ('arg', 8)]}
+    stores = ['STO 5, R1', 'STO 5, R2', 'LED R1']
+    tokens, saved = optimize(tokenize(stores), custom)
+    assert saved['stores'] == 0
+    assert [token_text(token) for token in tokens] == [
+        'STO 5,R1', 'STO 5,R2', 'LED R1'
+    ]